@@ -1,20 +1,31 @@
+import hashlib
 import os
-import re
-from time import sleep
-import urllib.request
+import time
 import xml.etree.ElementTree as ET
-from typing import List, Literal, Optional, Tuple
+from types import MappingProxyType
+from typing import Dict, List, Literal, Mapping, Optional, Tuple, Union
 
 import famplex
 import networkx as nx
 import numpy as np
 from pyvis.network import Network
 
-from .cooccurrence_analysis import CoocAnalyzer, _gilda_ground
+from .cooccurrence_analysis import CoocAnalyzer, SparseCooc, _gilda_ground
+from .grounding import default_service
+from .kegg_cache import KEGGCache
+from .kegg_rest import KEGGRestClient
 
 
 class KEGGpathway:
-    def __init__(self, kgml_path: str) -> None:
+    def __init__(
+        self,
+        kgml_path: Union[str, List[str]],
+        cache: Optional[KEGGCache] = None,
+        rest_client: Optional[KEGGRestClient] = None,
+    ) -> None:
+        # optional persistent cache of KEGG REST entries shared across pathways
+        self.cache = cache
+        self.rest_client = rest_client if rest_client else KEGGRestClient()
         # visualization options
         self.node_shapes = {
             "gene": "dot",
@@ -42,21 +53,37 @@ class KEGGpathway:
             "compound": "limegreen",
         }
 
-        if os.path.exists(kgml_path):
-            root = ET.parse(kgml_path).getroot()
-            self._parse_kgml(root)
+        # a list of KGML files is merged into one pathway (see _merge_kgml)
+        kgml_paths = [kgml_path] if isinstance(kgml_path, str) else list(kgml_path)
+        for path in kgml_paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError("Given KGML file was not found.")
+        roots = [ET.parse(path).getroot() for path in kgml_paths]
+        if isinstance(kgml_path, str):
+            self._parse_kgml(roots[0])
         else:
-            raise FileNotFoundError("Given KGML file was not found.")
+            self._merge_kgml(roots)
 
     def _parse_kgml(self, root) -> None:
         self.kegg_entries = {}
         self.pathwayID = root.attrib["name"]
         self.title = root.attrib["title"]
+        # seconds spent in each stage of parsing
+        self.timings = {}
+        start = time.perf_counter()
+        # fetch KEGG entries of all nodes at once
+        self._prefetch_entries(root)
+        self.timings["fetch"] = time.perf_counter() - start
         # parse nodes
+        start = time.perf_counter()
         self.entries = self._parse_nodes(root)
+        self.timings["parse"] = time.perf_counter() - start
 
+        start = time.perf_counter()
         self._ground_entries()
+        self.timings["ground"] = time.perf_counter() - start
 
+        start = time.perf_counter()
         self.graph = nx.DiGraph()
         self.graph.add_nodes_from([value for value in self.entries.values()])
 
@@ -65,6 +92,100 @@ class KEGGpathway:
 
         self.graph.add_edges_from(self.edges)
 
+        # grounded components of each node, resolved once
+        self.component_index = self._build_component_index()
+        self.timings["parse"] += time.perf_counter() - start
+
+    def _merge_kgml(self, roots) -> None:
+        # parses several maps into one graph in a single pass. Entries are
+        # identified across maps by a hash of their FamPlex parent, their
+        # grounded components (KEGG IDs if none could be grounded) or, for
+        # groups, the identities of their members (see _entry_hash), so the
+        # same gene, family or complex becomes one node. Merged entries are
+        # keyed by that hash and list the maps they appear in ("pathways")
+        self.kegg_entries = {}
+        self.pathwayID = "+".join(root.attrib["name"] for root in roots)
+        self.title = ", ".join(root.attrib["title"] for root in roots)
+        self.timings = {}
+        start = time.perf_counter()
+        # fetch KEGG entries of all maps at once
+        self._prefetch_entries(*roots)
+        self.timings["fetch"] = time.perf_counter() - start
+        self.timings["parse"] = 0.0
+        self.timings["ground"] = 0.0
+
+        self.entries = {}
+        self.relations = []
+        self.edges = []
+        names = {}  # node name -> hash of the entry it was given to
+        edge_pathways = {}
+        for root in roots:
+            pathway_ID = root.attrib["name"]
+            start = time.perf_counter()
+            entries = self._parse_nodes(root)
+            self.timings["parse"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            self._ground_entries(entries)
+            self.timings["ground"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            ids = {}  # map entry ID -> hash
+            # groups always come after their components
+            for idx, (node_name, attrib) in entries.items():
+                entry_hash = _entry_hash(attrib, ids)
+                ids[idx] = entry_hash
+                if entry_hash not in self.entries:
+                    attrib = {**attrib, "entry_ID": entry_hash, "pathways": []}
+                    # names are kept as in a single map (groups are named by
+                    # the symbols of their members), so merged and single-map
+                    # models share their species
+                    if attrib["type"] == "group":
+                        attrib["components"] = [
+                            ids[component] for component in attrib["components"]
+                        ]
+                    if names.get(node_name, entry_hash) != entry_hash:
+                        # different entities with the same symbols
+                        node_name = f"{node_name}_{entry_hash[:6]}"
+                    names[node_name] = entry_hash
+                    self.entries[entry_hash] = (node_name, attrib)
+                merged = self.entries[entry_hash][1]
+                if pathway_ID not in merged["pathways"]:
+                    merged["pathways"].append(pathway_ID)
+                if merged["type"] == "group":
+                    for component in merged["components"]:
+                        self.entries[component][1]["_group"] = entry_hash
+
+            # relations between the merged nodes
+            relations, edges = self._parse_edges(
+                root, {idx: self.entries[ids[idx]] for idx in entries}
+            )
+            for source_id, target_id, relation_dict in relations:
+                if "compound" in relation_dict:
+                    relation_dict["compound"] = ids.get(
+                        relation_dict["compound"], relation_dict["compound"]
+                    )
+                for subtype in relation_dict["subtypes"]:
+                    if subtype["name"] in ("compound", "hidden compound"):
+                        subtype["value"] = ids.get(subtype["value"], subtype["value"])
+                # shared by the edge dicts of all maps, so it survives merging
+                edge = (relation_dict["_source"], relation_dict["_target"])
+                relation_dict["pathways"] = edge_pathways.setdefault(edge, [])
+                if pathway_ID not in relation_dict["pathways"]:
+                    relation_dict["pathways"].append(pathway_ID)
+                self.relations.append((ids[source_id], ids[target_id], relation_dict))
+            self.edges.extend(edges)
+            self.timings["parse"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.graph = nx.DiGraph()
+        self.graph.add_nodes_from([value for value in self.entries.values()])
+        self.graph.add_edges_from(self.edges)
+
+        # grounded components of each node, resolved once
+        self.component_index = self._build_component_index()
+        self.timings["parse"] += time.perf_counter() - start
+
     def _parse_nodes(self, root) -> dict:
         entries = {}
         for entry in root.findall("./entry"):
@@ -131,14 +252,15 @@ class KEGGpathway:
 
         return entries
 
-    def _parse_edges(self, root) -> Tuple[list, list]:
+    def _parse_edges(self, root, entries: Optional[dict] = None) -> Tuple[list, list]:
+        entries = self.entries if entries is None else entries
         relations = []
         edges = []
         for relation in root.findall("./relation"):
             source_id = relation.attrib["entry1"]
             target_id = relation.attrib["entry2"]
-            source = self.entries[source_id][0]
-            target = self.entries[target_id][0]
+            source = entries[source_id][0]
+            target = entries[target_id][0]
             rel = relation.attrib["type"]
             relation_dict = {
                 "relation": rel,
@@ -191,74 +313,53 @@ class KEGGpathway:
             edges.append((source, target, relation_dict))
         return relations, edges
 
+    def _prefetch_entries(self, *roots) -> None:
+        # collect every gene/compound ID in the map(s) and fetch them in full
+        # batches, so that _parse_nodes only reads from self.kegg_entries
+        kegg_IDs = [
+            kegg_ID
+            for root in roots
+            for entry in root.findall("./entry")
+            if entry.attrib["type"] in ("gene", "compound")
+            for kegg_ID in entry.attrib["name"].split(" ")
+        ]
+        self._fetch_entries(kegg_IDs)
+
     def _get_component_dicts(self, kegg_IDs: List[str]) -> List[dict]:
+        self._fetch_entries(kegg_IDs)
+        return [self.kegg_entries[kegg_ID.rsplit(":")[1]] for kegg_ID in kegg_IDs]
+
+    def _fetch_entries(self, kegg_IDs: List[str]) -> None:
+        # fetches entries that are not in self.kegg_entries yet (cache first)
         to_process = []
-        for kegg_ID in kegg_IDs:
+        for kegg_ID in dict.fromkeys(kegg_IDs):  # deduplicate, keeping order
             kegg_ID_split = kegg_ID.rsplit(":")[1]
             if kegg_ID_split not in self.kegg_entries:
                 to_process.append(kegg_ID)
+        if to_process and self.cache is not None:
+            if self.cache.offline:
+                cached = self.cache.require(to_process)  # fail fast on cache miss
+            else:
+                cached = self.cache.get_many(to_process)
+            for entry in cached.values():
+                self.kegg_entries[entry["KEGGID"]] = entry
+            to_process = [kegg_ID for kegg_ID in to_process if kegg_ID not in cached]
         if to_process:
             new_entries = self._kegg_rest_get(to_process)
             for entry in new_entries:
                 self.kegg_entries[entry["KEGGID"]] = entry
-        return [self.kegg_entries[kegg_ID.rsplit(":")[1]] for kegg_ID in kegg_IDs]
+            if self.cache is not None:
+                full_IDs = {kegg_ID.rsplit(":")[1]: kegg_ID for kegg_ID in to_process}
+                self.cache.put_many(
+                    {
+                        full_IDs[entry["KEGGID"]]: entry
+                        for entry in new_entries
+                        if entry["KEGGID"] in full_IDs
+                    }
+                )
 
-    def _kegg_rest_get(
-        self,
-        kegg_IDs: List[str],
-        batch_size: int = 10,
-        retries: int = 3,
-        delay: int = 3,
-    ) -> List[dict]:
-        output = []
-        for i in range(0, len(kegg_IDs), batch_size):
-            id_list = kegg_IDs[i : i + batch_size]
-            url = "https://rest.kegg.jp/get/" + "+".join(id_list)
-            for _ in range(retries):
-                try:
-                    response = urllib.request.urlopen(url)
-                    break
-                except urllib.error.URLERROR as e:
-                    sleep(delay)
-            else:
-                raise e
-            res = response.read().decode()
-
-            lines = iter(res.splitlines())
-            for line in lines:
-                line = line.strip("\n")
-                if line.startswith("ENTRY"):
-                    entry_id = re.search(r"ENTRY\s+(\w+)\s", line).group(1)
-                    entry_dict = {"KEGGID": entry_id}
-
-                elif line.startswith("SYMBOL"):
-                    symbol = re.sub(r"SYMBOL\s+", "", line).split(", ")
-                    entry_dict["symbols"] = symbol
-
-                elif line.startswith("NAME"):
-                    name = re.search(r"NAME\s+(.+)", line).group(1).strip(";")
-                    entry_dict["name"] = name
-
-                elif line.startswith("DBLINKS"):
-                    db_links = {}
-                    db_link = re.search(r"DBLINKS\s+(.+):\s(\w+)", line)
-                    db_name = db_link.group(1)
-                    db_id = db_link.group(2)
-                    db_links[db_name] = db_id
-
-                    line = next(lines).strip("\n")
-                    while re.match(r"\s+", line):
-                        db_link = re.search(r"\s+(.+):\s+(\w+)", line)
-                        db_name = db_link.group(1)
-                        db_id = db_link.group(2)
-                        db_links[db_name] = db_id
-                        line = next(lines).strip("\n")
-                    entry_dict["db_links"] = db_links
-
-                if line.startswith("///"):
-                    output.append(entry_dict)
-
-        return output
+    def _kegg_rest_get(self, kegg_IDs: List[str]) -> List[dict]:
+        return self.rest_client.get_entries(kegg_IDs)
 
     def visualize(
         self,
@@ -274,13 +375,11 @@ class KEGGpathway:
         **kwargs,
     ) -> None:
         nt = Network(height, width, directed=directed, layout=layout, **kwargs)
-        graph = self.graph.copy()
-        if remove_lonely:
-            graph.remove_nodes_from(list(nx.isolates(self.graph)))
         if not network:
-            nt.from_nx(graph)
+            lonely = set(nx.isolates(self.graph)) if remove_lonely else set()
+            _from_nx(nt, self.graph, skip=lonely)
         else:
-            nt.from_nx(network)
+            _from_nx(nt, network)
         for node in nt.nodes:
             if informative:
                 node["shape"] = self.node_shapes[node["type"]]
@@ -383,11 +482,21 @@ class KEGGpathway:
                 edge["arrows"] = {"to": {"enabled": True, "type": "bar"}}
         nt.show(out_path)
 
-    def _ground_entries(self):
-        for key, entry in self.entries.items():
+    def _ground_entries(self, entries: Optional[dict] = None):
+        entries = self.entries if entries is None else entries
+        # ground every unique component once
+        groundings = default_service.ground_batch(
+            [
+                component
+                for entry in entries.values()
+                for component in entry[1]["components"]
+            ],
+            namespaces=["HGNC"],
+        )
+        for key, entry in entries.items():
             normalized_list = []
             for component in entry[1]["components"]:
-                grounded = _gilda_ground(component, namespaces=["HGNC"])
+                grounded = groundings[component]
                 if grounded:
                     normalized_list.append(grounded)
             entry[1]["normalized"] = normalized_list
@@ -406,57 +515,50 @@ class KEGGpathway:
                         flag = False
                 if flag:
                     entry[1]["parent"] = parent[1]
-                    self.entries[key] = (parent[1], entry[1])
+                    entries[key] = (parent[1], entry[1])
 
     def add_weights(self, cooc_data: CoocAnalyzer):
+        columns = self._component_columns(cooc_data.cooc.term_index)
         # adding node weights (word count)
-        entity_list = list(cooc_data.cv.get_feature_names_out())
-        count_vec = np.squeeze(np.asarray(cooc_data.word_count.sum(0)))
+        nodes = list(self.graph.nodes.keys())
+        weights, exists = _gather_node_weights(nodes, columns, cooc_data.cooc.counts)
+        # adding information to "weight" so the node size does not change
         weight_sum = 0
-        for node in self.graph.nodes.keys():
-            components = self._fetch_components(node)
-            weight = 0
-            counter = 0
-            for node_comp in components:
-                if node_comp in entity_list:
-                    idx = entity_list.index(node_comp)
-                    weight += count_vec[idx]
-                    counter += 1
-            if weight != 0:
-                # adding information to "weight" so the node size does not change
-                self.graph.nodes[node]["weight"] = weight / counter
-                self.graph.nodes[node]["exist"] = True
-            else:
-                self.graph.nodes[node]["weight"] = weight
-                self.graph.nodes[node]["exist"] = False
-            count = self.graph.nodes[node]["weight"]
-            weight_sum += count
+        for node, weight, exist in zip(nodes, weights, exists):
+            self.graph.nodes[node]["weight"] = weight
+            self.graph.nodes[node]["exist"] = exist
+            weight_sum += weight
         # normalizing weights
         for node_values in self.graph.nodes.values():
             node_values["weight"] /= weight_sum
         # adding edge weights
-        for source, target in self.graph.edges.keys():
-            source_comps = self._fetch_components(source)
-            target_comps = self._fetch_components(target)
-            weight = 0
-            counter = 0
-            exist = False
-            for s_comp in source_comps:
-                for t_comp in target_comps:
-                    wei, exi = cooc_data._fetch_weight_from_network(s_comp, t_comp)
-                    weight += wei
-                    exist = exist | exi
-                    if exi:
-                        counter += 1
-            if exist:
-                self.graph[source][target]["weight"] = (
-                    weight / counter
-                )  # averaging weights
-            else:
-                self.graph[source][target]["weight"] = weight
+        edges = list(self.graph.edges.keys())
+        weights, exists = _gather_edge_weights(edges, columns, cooc_data.cooc)
+        for (source, target), weight, exist in zip(edges, weights, exists):
+            self.graph[source][target]["weight"] = weight
             self.graph[source][target]["exist"] = exist
 
+    def _build_component_index(self) -> Mapping[str, Tuple[str, ...]]:
+        return MappingProxyType(
+            {node: tuple(self._resolve_components(node)) for node in self.graph.nodes}
+        )
+
+    def _component_columns(self, term_index: Dict[str, int]) -> Dict[str, np.ndarray]:
+        # maps the components of each node to their column in a co-occurrence
+        # vocabulary; components outside the vocabulary are mapped to -1
+        return {
+            node: np.array(
+                [term_index.get(comp, -1) for comp in components], dtype=np.int64
+            )
+            for node, components in self.component_index.items()
+        }
+
     def _fetch_components(self, node) -> List[str]:
+        if node in self.component_index:
+            return list(self.component_index[node])
+        return self._resolve_components(node)
+
+    def _resolve_components(self, node) -> List[str]:
         # fetch names of the components of a given node
         components = []
         if self.graph.nodes[node]["type"] == "group":
@@ -483,56 +585,128 @@ class KEGGpathway:
         cooc_data: CoocAnalyzer,
     ):
         pathway = self.graph.copy()
+        sub_counts, sub_cooc = cooc_data._analyze_sub_cooc(query_list, method)
+        columns = self._component_columns(sub_cooc.term_index)
         # adding edge weights
-        sub_counts, subG = cooc_data._analyze_sub_cooc(query_list, method)
-        for source, target in pathway.edges.keys():
-            source_comps = self._fetch_components(source)
-            target_comps = self._fetch_components(target)
-            weight = 0
-            counter = 0
-            exist = False
-            for s_comp in source_comps:
-                for t_comp in target_comps:
-                    wei, exi = cooc_data._fetch_weight_from_network(
-                        s_comp, t_comp, subG
-                    )
-                    weight += wei
-                    exist = exist | exi
-                    if exi:
-                        counter += 1
-            if exist:
-                pathway[source][target]["weight"] = (
-                    weight / counter
-                )  # averaging weights
-            else:
-                pathway[source][target]["weight"] = weight
+        edges = list(pathway.edges.keys())
+        weights, exists = _gather_edge_weights(edges, columns, sub_cooc)
+        for (source, target), weight, exist in zip(edges, weights, exists):
+            pathway[source][target]["weight"] = weight
             pathway[source][target]["exist"] = exist
-        weight_sum = nx.adjacency_matrix(pathway).sum()
-        for source, target in pathway.edges.keys():
+        for source, target in edges:
             pathway[source][target]["weight"] /= self.graph[source][target]["weight"]
 
         # adding node weights
+        nodes = list(pathway.nodes.keys())
+        weights, exists = _gather_node_weights(nodes, columns, sub_cooc.counts)
         weight_sum = 0
-        for node in pathway.nodes.keys():
-            components = self._fetch_components(node)
-            weight = 0
-            counter = 0
-            for node_comp in components:
-                if node_comp in sub_counts:
-                    weight += sub_counts[node_comp]
-                    counter += 1
-            if weight != 0:
-                pathway.nodes[node]["weight"] = weight / counter
+        for node, weight, exist in zip(nodes, weights, exists):
+            pathway.nodes[node]["weight"] = weight
+            if exist:
                 pathway.nodes[node]["exist"] = True
-            else:
-                pathway.nodes[node]["weight"] = weight
-                pathway.nodes[node]["weight"] = False
-            count = pathway.nodes[node]["weight"]
-            weight_sum += count
+            weight_sum += weight
         # normalizing & highlighting sizes
-        for node in pathway.nodes.keys():
+        for node in nodes:
             pathway.nodes[node]["weight"] /= weight_sum
             if self.graph.nodes[node]["exist"]:
                 pathway.nodes[node]["weight"] /= self.graph.nodes[node]["weight"]
 
         return pathway
+
+
+def _entry_hash(attrib: dict, ids: Dict[str, str]) -> str:
+    # identity of an entry across maps; `ids` maps the entry IDs of the
+    # members of a group to their hashes
+    if attrib["type"] == "group":
+        key = ["group"] + sorted(ids[component] for component in attrib["components"])
+    elif "parent" in attrib:
+        key = ["FPLX", attrib["parent"]]
+    elif attrib["normalized"]:
+        key = [attrib["type"]] + sorted(set(attrib["normalized"]))
+    else:
+        key = [attrib["type"]] + sorted(set(attrib["kegg_IDs"]))
+    return hashlib.sha1("\t".join(key).encode("utf-8")).hexdigest()[:16]
+
+
+def _gather_node_weights(
+    nodes: List[str], columns: Dict[str, np.ndarray], count_vec: np.ndarray
+) -> Tuple[list, list]:
+    # averages the word counts of the components of each node that are found in
+    # the vocabulary; nodes without any counts get a weight of 0
+    group = np.repeat(np.arange(len(nodes)), [len(columns[node]) for node in nodes])
+    cols = np.concatenate([columns[node] for node in nodes] + [np.zeros(0, int)])
+    values = np.zeros(len(cols))
+    valid = cols >= 0
+    values[valid] = count_vec[cols[valid]]
+    totals = np.bincount(group, weights=values, minlength=len(nodes))
+    counters = np.bincount(group, weights=values > 0, minlength=len(nodes))
+    weights = []
+    exists = []
+    for total, counter in zip(totals, counters):
+        if total != 0:
+            weights.append(total / counter)
+            exists.append(True)
+        else:
+            weights.append(0)
+            exists.append(False)
+    return weights, exists
+
+
+def _gather_edge_weights(
+    edges: List[Tuple[str, str]], columns: Dict[str, np.ndarray], cooc: SparseCooc
+) -> Tuple[list, list]:
+    # averages the co-occurrences of all source x target component pairs of each
+    # edge; pairs that never co-occur count as 1 (same as
+    # CoocAnalyzer._fetch_weight_from_network) but are left out of the average
+    rows = [np.zeros(0, int)]
+    cols = [np.zeros(0, int)]
+    sizes = []
+    for source, target in edges:
+        s_cols = columns[source]
+        t_cols = columns[target]
+        rows.append(np.repeat(s_cols, len(t_cols)))
+        cols.append(np.tile(t_cols, len(s_cols)))
+        sizes.append(len(s_cols) * len(t_cols))
+    group = np.repeat(np.arange(len(edges)), sizes)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    values = np.zeros(len(rows))
+    valid = (rows >= 0) & (cols >= 0)
+    if valid.any():
+        values[valid] = cooc.gather(rows[valid], cols[valid])
+    exist = values != 0
+    totals = np.bincount(
+        group, weights=np.where(exist, values, 1), minlength=len(edges)
+    )
+    counters = np.bincount(group, weights=exist, minlength=len(edges))
+    weights = []
+    exists = []
+    for total, counter in zip(totals, counters):
+        if counter > 0:
+            weights.append(float(total / counter))  # averaging weights
+            exists.append(True)
+        else:
+            weights.append(int(total))
+            exists.append(False)
+    return weights, exists
+
+
+def _from_nx(nt: Network, graph: nx.DiGraph, skip: Optional[set] = None) -> None:
+    # same result as nt.from_nx(graph) without the nodes in skip, but reads the
+    # graph instead of modifying its attribute dicts, so no copy is needed
+    skip = skip if skip else set()
+
+    def node_options(node) -> dict:
+        attrs = graph.nodes[node]
+        return {**attrs, "size": int(attrs.get("size", 10))}
+
+    for source, target, attrs in graph.edges(data=True):
+        nt.add_node(source, **node_options(source))
+        nt.add_node(target, **node_options(target))
+        options = dict(attrs)
+        if ("value" not in options) or ("width" not in options):
+            options["width"] = options.pop("weight", 1)
+        nt.add_edge(source, target, **options)
+    for node in nx.isolates(graph):
+        if node not in skip:
+            nt.add_node(node, **{"size": 10, **graph.nodes[node]})
@@ -1,17 +1,137 @@
-from typing import Tuple
+import sys
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 import networkx as nx
 
 from .KGML_parser import KEGGpathway
 
 
+class Reaction(NamedTuple):
+    # one line of a Text2Model file, e.g. reactants=("EGFR", "ERK"),
+    # verb="phosphorylates", products=("a_ERK",) for "EGFR phosphorylates ERK ->
+    # a_ERK"; parameters are written after "|" (e.g. {"kf": 1.0})
+    reactants: Tuple[str, ...]
+    verb: str
+    products: Tuple[str, ...] = ()
+    reversible: bool = False
+    parameters: Optional[Dict[str, float]] = None
+
+    def __str__(self) -> str:
+        line = " ".join([self.reactants[0], self.verb, *self.reactants[1:]])
+        if self.products:
+            arrow = " <-> " if self.reversible else " -> "
+            line += arrow + " + ".join(self.products)
+        if self.parameters:
+            line += " | " + ", ".join(f"{k}={v}" for k, v in self.parameters.items())
+        return line
+
+
 def to_text2model(pathway: KEGGpathway) -> Tuple[nx.DiGraph, str]:
-    output = pathway.graph.copy()
+    output = _convert_graph(pathway).to_networkx(pathway.graph.graph)
+    reactions = _list_reactions(output)
+    return output, reactions
+
+
+def iter_text2model(pathway: KEGGpathway) -> Iterator[Reaction]:
+    # reactions of the pathway, generated one at a time
+    network = _convert_graph(pathway)
+    return _iter_reactions(network.nodes, network.succ)
+
+
+def write_text2model(
+    reactions: Iterable[Reaction], file: Union[str, TextIO, None] = None
+) -> int:
+    # streams reactions to a file path or an open text file (default: stdout),
+    # one line each, and returns the number of lines written
+    if isinstance(file, str):
+        with open(file, "w") as f:
+            return write_text2model(reactions, f)
+    file = sys.stdout if file is None else file
+    n_lines = 0
+    for reaction in reactions:
+        file.write(f"{reaction}\n")
+        n_lines += 1
+    return n_lines
+
+
+class _EdgeList:
+    # lightweight, ordered directed graph (node -> attributes and node ->
+    # successor -> attributes) with the node and edge order of nx.DiGraph.
+    # Attribute dicts are shared with the graph it was built from and are
+    # replaced instead of being modified, so the source graph is only read
+    def __init__(self, graph: nx.DiGraph) -> None:
+        self.nodes = dict(graph.nodes.items())
+        self.succ = {node: dict(successors) for node, successors in graph.adj.items()}
+
+    def __contains__(self, node) -> bool:
+        return node in self.nodes
+
+    def add_node(self, node, **attrs) -> None:
+        if node in self.nodes:
+            self.nodes[node] = {**self.nodes[node], **attrs}
+        else:
+            self.nodes[node] = attrs
+            self.succ[node] = {}
+
+    def add_edge(self, source, target, attrs: dict) -> None:
+        # like nx.DiGraph.add_edge(source, target, **attrs)
+        for node in [source, target]:
+            if node not in self.nodes:
+                self.add_node(node)
+        successors = self.succ[source]
+        if target in successors:
+            successors[target] = {**successors[target], **attrs}
+        else:
+            successors[target] = attrs
+
+    def remove_edges_from(self, edges: Iterable[Tuple]) -> None:
+        for source, target in edges:
+            if source in self.succ:
+                self.succ[source].pop(target, None)
+
+    def remove_isolates(self) -> None:
+        targets = {target for successors in self.succ.values() for target in successors}
+        for node in list(self.nodes):
+            if (not self.succ[node]) and (node not in targets):
+                del self.nodes[node]
+                del self.succ[node]
+
+    def edges(self) -> List[Tuple]:
+        return [
+            (source, target, attrs)
+            for source in self.nodes
+            for target, attrs in self.succ[source].items()
+        ]
+
+    def to_networkx(self, graph_attrs: Optional[dict] = None) -> nx.DiGraph:
+        graph = nx.DiGraph(**(graph_attrs or {}))
+        graph.add_nodes_from(self.nodes.items())
+        graph.add_edges_from(self.edges())
+        return graph
+
+
+def _convert_graph(pathway: KEGGpathway) -> _EdgeList:
+    # applies the rewriting rules (group edges, a_/u_ intermediates, moved
+    # inhibition edges) in one pass over read-only views of pathway.graph
+    output = _EdgeList(pathway.graph)
     _reassign_group_edges(pathway, output)
-    output.remove_nodes_from(list(nx.isolates(output)))  # remove lonely nodes
-    network = output.copy()
+    output.remove_isolates()  # remove lonely nodes
+    # the rules are applied to the edges as they are after group reassignment
+    network_edges = output.edges()
+    network_succ = {node: dict(successors) for node, successors in output.succ.items()}
     remove_edges = set()
-    for (source, target), edge_dict in network.edges.items():
+    for source, target, edge_dict in network_edges:
         if edge_dict["relation"] == "GErel":
             # do nothing
             pass
@@ -19,26 +139,26 @@ def to_text2model(pathway: KEGGpathway) -> Tuple[nx.DiGraph, str]:
             if edge_dict["type"] == "ubiquitination":
                 new_node = "u_" + target
                 if new_node not in output:
-                    level = network.nodes[target]["level"] + 60 / 150
+                    level = output.nodes[target]["level"] + 60 / 150
                     output.add_node(new_node, type="intermediate", level=level)
-                    output.add_edge(target, new_node, type="transition")
+                    output.add_edge(target, new_node, {"type": "transition"})
             elif (edge_dict["type"] == "dephosphorylation") or (
                 edge_dict["type"] == "inhibition"
             ):
                 new_node = "a_" + target
                 if new_node not in output:
-                    level = network.nodes[target]["level"] + 60 / 150
+                    level = output.nodes[target]["level"] + 60 / 150
                     output.add_node(new_node, type="intermediate", level=level)
                 # move original edge target to new node
-                output.add_edge(source, new_node, **edge_dict)
+                output.add_edge(source, new_node, edge_dict)
                 # add new transition node
-                output.add_edge(new_node, target, type="transition")
+                output.add_edge(new_node, target, {"type": "transition"})
                 # delete original edge
                 remove_edges.add((source, target))
                 if edge_dict["effect"] == -1:
                     # move all outgoing edges from the target node to new node
-                    for child in network[target]:
-                        output.add_edge(new_node, child, **network[target][child])
+                    for child, child_dict in network_succ[target].items():
+                        output.add_edge(new_node, child, child_dict)
                         # remove copied edge from the original node
                         remove_edges.add((target, child))
                 continue
@@ -48,19 +168,18 @@ def to_text2model(pathway: KEGGpathway) -> Tuple[nx.DiGraph, str]:
             else:
                 new_node = "a_" + target
                 if new_node not in output:
-                    level = network.nodes[target]["level"] + 60 / 150
+                    level = output.nodes[target]["level"] + 60 / 150
                     output.add_node(new_node, type="intermediate", level=level)
-                    output.add_edge(target, new_node, type="transition")
+                    output.add_edge(target, new_node, {"type": "transition"})
                 if edge_dict["effect"] == 1:
-                    for child in network[target]:
-                        output.add_edge(new_node, child, **network[target][child])
+                    for child, child_dict in network_succ[target].items():
+                        output.add_edge(new_node, child, child_dict)
                         remove_edges.add((target, child))
     output.remove_edges_from(remove_edges)
-    reactions = _list_reactions(output)
-    return output, reactions
+    return output
 
 
-def _reassign_group_edges(pathway: KEGGpathway, output: nx.DiGraph):
+def _reassign_group_edges(pathway: KEGGpathway, output: _EdgeList):
     # reassigns edges that are to/from a node that belongs to a group
     groups = [
         key for key, value in pathway.graph.nodes.items() if value["type"] == "group"
@@ -72,65 +191,89 @@ def _reassign_group_edges(pathway: KEGGpathway, output: nx.DiGraph):
         ]
         for comp in components:
             for source in pathway.graph.predecessors(comp):
-                output.add_edge(source, group, **pathway.graph[source][comp])
+                output.add_edge(source, group, pathway.graph[source][comp])
                 remove_edges.add((source, comp))
             for target in pathway.graph.successors(comp):
-                output.add_edge(group, target, **pathway.graph[comp][target])
+                output.add_edge(group, target, pathway.graph[comp][target])
                 remove_edges.add((comp, target))
     output.remove_edges_from(remove_edges)
 
 
 def _list_reactions(network):
-    sorted_nodes = _sort_nodes_by_level(network)
-    sorted_edges = sorted(
-        nx.line_graph(network), key=lambda x: sorted_nodes.index(x[0])
-    )
-    reactions = ""
+    return "".join(f"{reaction}\n" for reaction in iter_reactions(network))
+
+
+def iter_reactions(network: nx.DiGraph) -> Iterator[Reaction]:
+    return _iter_reactions(network.nodes, network.adj)
+
+
+def _iter_reactions(nodes: Mapping, succ: Mapping) -> Iterator[Reaction]:
+    # nodes: node -> attributes, succ: node -> successor -> edge attributes
+    rank = {node: i for i, node in enumerate(_sort_nodes_by_level(nodes))}
+    # edges ordered by the level of their source node; ties keep the order in
+    # which nx.line_graph used to list the edges
+    sorted_edges = sorted(_line_graph_edge_order(succ), key=lambda x: rank[x[0]])
+    seen = set()  # reverse reactions that have been listed already
     for source, target in sorted_edges:
-        edge_dict = network[source][target]
+        edge_dict = succ[source][target]
         if edge_dict["type"] == "transition":
             continue
         elif edge_dict["type"] == "bind":
-            reactions += f"{source} binds {target} <-> {source}_{target}\n"
+            yield Reaction(
+                (source, target), "binds", (f"{source}_{target}",), reversible=True
+            )
         elif edge_dict["relation"] == "GErel":
             if edge_dict["effect"] == 1:
-                reactions += f"{source} transcribes {target}\n"
+                yield Reaction((source, target), "transcribes")
             elif edge_dict["effect"] == -1:
-                reactions += f"{source} degrades {target}\n"
+                yield Reaction((source, target), "degrades")
         elif edge_dict["relation"] == "PPrel":
             if edge_dict["type"] == "phosphorylation":
                 product = "a_" + target
-                reactions += f"{source} phosphorylates {target} -> {product}\n"
-                new_reaction = f"{product} is dephosphorylated -> {target}\n"
-                if new_reaction not in reactions:
-                    reactions += new_reaction
+                yield Reaction((source, target), "phosphorylates", (product,))
+                new_reaction = Reaction((product,), "is dephosphorylated", (target,))
+                if new_reaction not in seen:
+                    seen.add(new_reaction)
+                    yield new_reaction
             elif edge_dict["type"] == "dephosphorylation":
                 product = target.strip("a_")
-                reactions += f"{source} dephosphorylates {target} -> {product}\n"
+                yield Reaction((source, target), "dephosphorylates", (product,))
             elif edge_dict["type"] == "ubiquitination":
                 product = "u_" + target
-                reactions += f"{source} ubiquitinates {target} -> {product}\n"
-                reactions += f"{product} is degraded\n"
+                yield Reaction((source, target), "ubiquitinates", (product,))
+                yield Reaction((product,), "is degraded")
             elif edge_dict["type"] == "dissociation":
                 continue
             elif (edge_dict["effect"] == 1) or (
                 edge_dict["type"] == "binding/association"
             ):
                 product = "a_" + target
-                reactions += f"{source} activates {target} -> {product}\n"
-                new_reaction = f"{product} is deactivated -> {target}\n"
-                if new_reaction not in reactions:
-                    reactions += new_reaction
+                yield Reaction((source, target), "activates", (product,))
+                new_reaction = Reaction((product,), "is deactivated", (target,))
+                if new_reaction not in seen:
+                    seen.add(new_reaction)
+                    yield new_reaction
             elif edge_dict["effect"] == -1:
                 product = target.strip("a_")
-                reactions += f"{source} deactivates {target} -> {product}\n"
-    return reactions
+                yield Reaction((source, target), "deactivates", (product,))
+
+
+def _line_graph_edge_order(succ: Mapping) -> List[Tuple]:
+    # edges in the node order of nx.line_graph(network), without building it:
+    # each edge is followed by the not yet listed edges leaving its target
+    order = {}
+    for source, successors in succ.items():
+        for target in successors:
+            order.setdefault((source, target))
+            for child in succ[target]:
+                order.setdefault((target, child))
+    return list(order)
 
 
-def _sort_nodes_by_level(network):
-    # sorts nodes in given network by their "level" value
+def _sort_nodes_by_level(nodes: Mapping) -> List:
+    # sorts nodes by their "level" value
     sorted_nodes = sorted(
-        [(key, value) for key, value in network.nodes.items()],
+        [(key, value) for key, value in nodes.items()],
         key=lambda x: x[1]["level"],
     )
     return [item[0] for item in sorted_nodes]
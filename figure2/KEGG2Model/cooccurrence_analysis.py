@@ -1,50 +1,301 @@
 import gzip
 import json
 import os
-from typing import List, Literal, Optional, Tuple, Union
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import reduce
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
-import gilda
 import networkx as nx
 import numpy as np
-from sklearn.feature_extraction.text import CountVectorizer
+from scipy import sparse
+
+from .entity_vocabulary import EntityVocabulary, count_matrix
+from .grounding import default_service
+from .pubtator_corpus import (
+    PubTatorCorpus,
+    iter_sentence_batches,
+    iter_shard_records,
+    read_manifest,
+    shard_changes,
+)
 
 
 class CoocAnalyzer:
-    def __init__(self, datapath: str) -> None:
+    # vocabulary: entity vocabulary of an earlier run (EntityVocabulary.load),
+    # whose ids are kept for json data and shards; new entities are appended
+    def __init__(
+        self, datapath: str, vocabulary: Optional[EntityVocabulary] = None
+    ) -> None:
         if os.path.exists(datapath):
             self.datapath = datapath
         else:
             raise FileNotFoundError("Given data directory was not found.")
+        self.vocabulary = vocabulary
 
     def load_pubtator_data(self) -> None:
+        # accepts pubtator_data.json(.gz), a directory in the binary corpus
+        # format (see pubtator_corpus.py), which is memory-mapped, or the output
+        # directory of pubtator/process_data.py, whose shards are streamed
+        self._corpus_position = None  # manifest lines reflected in the corpus
+        if PubTatorCorpus.is_corpus(self.datapath):
+            self.corpus = PubTatorCorpus.load(self.datapath)
+        elif PubTatorCorpus.is_shard_store(self.datapath):
+            self._load_shards()
+        else:
+            self.pubtator_data = self._read_json()
+            self.corpus = PubTatorCorpus.from_records(
+                self.pubtator_data, self.vocabulary
+            )
+        self._build_index()
+
+    def _read_json(self) -> List[dict]:
         if self.datapath.endswith(".gz"):
             with gzip.open(self.datapath, "rb") as f:
-                self.pubtator_data = json.load(f)
+                return json.load(f)
         else:
             with open(self.datapath, "r") as f:
-                self.pubtator_data = json.load(f)
-
-    def _dummy(self, tokens: List[str]) -> List[str]:
-        return tokens
-
-    def calculate_cooc(self, set_diag_0: bool = True) -> None:
-        self.cv = CountVectorizer(preprocessor=self._dummy, tokenizer=self._dummy)
-        self.word_count = self.cv.fit_transform(
-            [
-                entities
-                for data in self.pubtator_data
-                for entities in data["entities"]
-                if len(entities) > 1
-            ]
+                return json.load(f)
+
+    def _load_shards(self, vocabulary: Optional[EntityVocabulary] = None) -> None:
+        self._corpus_position = len(read_manifest(self.datapath))
+        self.corpus = PubTatorCorpus.from_shards(
+            self.datapath,
+            vocabulary=vocabulary if vocabulary is not None else self.vocabulary,
+        )
+
+    def _build_index(self) -> None:
+        # the sentence rows of each article and an inverted entity -> article
+        # index; both are memory-mapped for a binary corpus, so that they are
+        # shared between processes
+        self._set_vocabulary(self.corpus.vocabulary)
+        self.article_ptr = np.asarray(self.corpus.article_ptr)
+        self.postings_ptr, self.postings = self.corpus.postings()
+
+    @property
+    def sentence_matrix(self) -> sparse.csr_matrix:
+        # word counts of every sentence (including single-entity ones), built
+        # from the corpus when needed
+        return self.corpus.sentence_matrix()
+
+    def _set_vocabulary(self, vocabulary: EntityVocabulary) -> None:
+        self.vocabulary = vocabulary
+        self.entity_list = vocabulary.terms
+        self.term_index = vocabulary.index
+
+    def _posting_list(self, entity: str) -> np.ndarray:
+        idx = self.term_index.get(entity)
+        if (idx is None) or (idx >= len(self.postings_ptr) - 1):
+            return np.zeros(0, dtype=self.postings.dtype)
+        return np.asarray(
+            self.postings[self.postings_ptr[idx] : self.postings_ptr[idx + 1]]
         )
-        self.cooc_matrix = self.word_count.T * self.word_count
+
+    def _article_rows(self, articles: np.ndarray) -> np.ndarray:
+        # sentence rows of the given articles, in order
+        starts = self.article_ptr[articles]
+        lengths = self.article_ptr[articles + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+    @staticmethod
+    def _multi_entity_rows(sentence_matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+        # only sentences with more than one entity are used
+        n_entities = np.asarray(sentence_matrix.sum(1)).ravel()
+        return sentence_matrix[np.flatnonzero(n_entities > 1)]
+
+    def calculate_cooc(
+        self,
+        set_diag_0: bool = True,
+        chunk_size: Optional[int] = None,
+        n_jobs: int = 1,
+    ) -> None:
+        # with chunk_size, the matrix is accumulated out-of-core from batches of
+        # about chunk_size sentences streamed from datapath (see _chunked_cooc),
+        # and load_pubtator_data is not needed
+        if chunk_size is not None:
+            self.word_count = None
+            self.cooc_matrix, counts = self._chunked_cooc(chunk_size, n_jobs)
+        else:
+            self.word_count = self._multi_entity_rows(self.sentence_matrix)
+            self.cooc_matrix = (self.word_count.T * self.word_count).tocsr()
+            counts = np.squeeze(np.asarray(self.word_count.sum(0)), axis=0)
+            # manifest lines of the shard directory reflected in the matrix
+            self.manifest_position = self._corpus_position
         if set_diag_0 is True:
             self.cooc_matrix.setdiag(0)
-        self.network = nx.from_numpy_array(self.cooc_matrix.toarray())
-        labels = {}
-        for idx, label in enumerate(self.cv.get_feature_names_out()):
-            labels[idx] = label
-        self.network = nx.relabel_nodes(self.network, labels)
+            self.cooc_matrix.eliminate_zeros()
+        self.set_diag_0 = set_diag_0
+        self.cooc = SparseCooc(self.cooc_matrix, self.term_index, counts)
+        self._network = None
+
+    def _chunked_cooc(
+        self, chunk_size: int, n_jobs: int = 1
+    ) -> Tuple[sparse.csr_matrix, np.ndarray]:
+        # sums the co-occurrence products of sentence batches, optionally on a
+        # pool of n_jobs processes, so that only one batch per process and the
+        # (entities x entities) result are held in memory. The vocabulary is the
+        # loaded one (if load_pubtator_data was called, other entities are
+        # dropped), the one of a binary corpus, or grown while streaming; the
+        # entity order is the same as with load_pubtator_data either way
+        self.manifest_position = None
+        grow = False
+        sort = False
+        if PubTatorCorpus.is_corpus(self.datapath):
+            corpus = PubTatorCorpus.load(self.datapath)
+            vocabulary = corpus.vocabulary
+            batches = corpus.iter_batches(chunk_size)
+        else:
+            if hasattr(self, "corpus"):
+                vocabulary = self.vocabulary
+            else:
+                grow = True
+                sort = self.vocabulary is None
+                vocabulary = EntityVocabulary(self.vocabulary or [])
+            if PubTatorCorpus.is_shard_store(self.datapath):
+                self.manifest_position = len(read_manifest(self.datapath))
+                records, min_sentences = iter_shard_records(self.datapath), 2
+            else:
+                records, min_sentences = self._read_json(), 0
+            batches = iter_sentence_batches(
+                records, vocabulary, chunk_size, grow, min_sentences
+            )
+
+        cooc_matrix = sparse.csr_matrix((0, 0), dtype=np.int64)
+        counts = np.zeros(0, dtype=np.int64)
+
+        def add(result: Tuple[sparse.csr_matrix, np.ndarray]) -> None:
+            nonlocal cooc_matrix, counts
+            batch_matrix, batch_counts = result
+            # the vocabulary may have grown since the previous batches
+            n_terms = max(len(counts), len(batch_counts))
+            cooc_matrix = _resized(cooc_matrix, n_terms) + _resized(
+                batch_matrix, n_terms
+            )
+            counts = np.pad(counts, (0, n_terms - len(counts)))
+            counts[: len(batch_counts)] += batch_counts
+
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                pending = set()
+                for sentence_ptr, entity_ids in batches:
+                    pending.add(
+                        executor.submit(
+                            _batch_cooc, sentence_ptr, entity_ids, len(vocabulary)
+                        )
+                    )
+                    if len(pending) >= 2 * n_jobs:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            add(future.result())
+                for future in pending:
+                    add(future.result())
+        else:
+            for sentence_ptr, entity_ids in batches:
+                add(_batch_cooc(sentence_ptr, entity_ids, len(vocabulary)))
+
+        # entities that only appear in single-entity sentences
+        n_terms = len(vocabulary)
+        cooc_matrix = _resized(cooc_matrix, n_terms)
+        counts = np.pad(counts, (0, n_terms - len(counts)))
+        if sort:
+            # renumber the entities in sorted order, as load_pubtator_data does
+            vocabulary, new_ids = vocabulary.sorted()
+            order = np.argsort(new_ids)
+            cooc_matrix = cooc_matrix[order][:, order]
+            counts = counts[order]
+        self._set_vocabulary(vocabulary)
+        return cooc_matrix.tocsr(), counts
+
+    def update_cooc(self) -> None:
+        # applies the articles that process_data.py added, changed or removed
+        # since the co-occurrence matrix was calculated (e.g. for a new PubTator
+        # release) by adding the delta products of their word counts:
+        # cooc += added.T * added - removed.T * removed
+        if getattr(self, "manifest_position", None) is None:
+            raise ValueError(
+                "update_cooc requires the output directory of process_data.py."
+            )
+        removed, added, position = shard_changes(self.datapath, self.manifest_position)
+        new_terms = {
+            entity
+            for data in added
+            for entities in data["entities"]
+            for entity in entities
+            if entity not in self.term_index
+        }
+        vocabulary = EntityVocabulary(self.vocabulary)
+        vocabulary.extend(sorted(new_terms))
+        added_count, removed_count = [
+            self._multi_entity_rows(
+                PubTatorCorpus.from_records(records, vocabulary).sentence_matrix()
+            )
+            for records in [added, removed]
+        ]
+        n_terms = len(vocabulary)
+        cooc_matrix = self.cooc_matrix.copy()
+        cooc_matrix.resize((n_terms, n_terms))
+        cooc_matrix = (
+            cooc_matrix + added_count.T * added_count - removed_count.T * removed_count
+        ).tocsr()
+        if self.set_diag_0 is True:
+            cooc_matrix.setdiag(0)
+        cooc_matrix.eliminate_zeros()
+        counts = np.zeros(n_terms, dtype=np.int64)
+        counts[: len(self.cooc.counts)] = self.cooc.counts
+        counts += np.asarray(added_count.sum(0)).ravel()
+        counts -= np.asarray(removed_count.sum(0)).ravel()
+
+        # the article index is rebuilt from the shards if it is out of date
+        if (getattr(self, "_corpus_position", None) != position) or (
+            n_terms > len(self.entity_list)
+        ):
+            self._load_shards(vocabulary)
+            self._build_index()
+        self.word_count = self._multi_entity_rows(self.sentence_matrix)
+        self.cooc_matrix = cooc_matrix
+        self.manifest_position = position
+        self.cooc = SparseCooc(self.cooc_matrix, self.term_index, counts)
+        self._network = None
+
+    def save_cooc(self, path: str) -> None:
+        # stores the co-occurrence matrix, so that it can be updated later
+        self.cooc.save(path)
+        with open(os.path.join(path, "state.json"), "w") as f:
+            json.dump(
+                {
+                    "manifest_position": self.manifest_position,
+                    "set_diag_0": self.set_diag_0,
+                },
+                f,
+            )
+
+    def load_cooc(self, path: str) -> None:
+        # restores a matrix saved by save_cooc (instead of calculate_cooc) and
+        # loads the shards of datapath with the same entity order
+        self.cooc = SparseCooc.load(path)
+        with open(os.path.join(path, "state.json"), "r") as f:
+            state = json.load(f)
+        self.manifest_position = state["manifest_position"]
+        self.set_diag_0 = state["set_diag_0"]
+        self._load_shards(EntityVocabulary(self.cooc.terms))
+        self._build_index()
+        # entities that only appear in shards written after the matrix was saved
+        n_terms = len(self.entity_list)
+        self.cooc.matrix.resize((n_terms, n_terms))
+        self.cooc.counts = np.concatenate(
+            [self.cooc.counts, np.zeros(n_terms - len(self.cooc.counts), np.int64)]
+        )
+        self.cooc.term_index = self.term_index
+        self.cooc_matrix = self.cooc.matrix
+        self.word_count = self._multi_entity_rows(self.sentence_matrix)
+        self._network = None
+
+    @property
+    def network(self) -> nx.Graph:
+        # NetworkX view of the co-occurrence matrix, only built when requested
+        if self._network is None:
+            self._network = self.cooc.to_networkx()
+        return self._network
 
     def _analyze_sub_cooc(self, query_list: List[str], method: Literal["AND", "OR"]):
         # returns results of co-occurrence analysis on a subset of articles
@@ -63,46 +314,33 @@ class CoocAnalyzer:
             print("No valid search query.")
             return
 
-        query_set = set(grounded_list)
-
-        def operand(query_set: set, article_set: set):
-            if method == "AND":
-                return query_set.issubset(article_set)
-            elif method == "OR":
-                return not query_set.isdisjoint(article_set)
-
         # obtain a list of articles relevant to the query
-        articles = []
-        for idx, data in enumerate(self.pubtator_data):
-            ent_set = set([])
-            for entities in data["entities"]:
-                ent_set |= set(entities)
-            if operand(query_set, ent_set):
-                articles.append(idx)
+        posting_lists = [self._posting_list(query) for query in set(grounded_list)]
+        if method == "AND":
+            articles = reduce(np.intersect1d, posting_lists)
+        elif method == "OR":
+            articles = reduce(np.union1d, posting_lists)
         # calculate the sub-co-occurrence network with the article list
-        filtered_data = [
-            entities
-            for article in articles
-            for entities in self.pubtator_data[article]["entities"]
-        ]
-        cv = CountVectorizer(preprocessor=self._dummy, tokenizer=self._dummy)
-        word_count = cv.fit_transform(filtered_data)
-        entity_list = list(cv.get_feature_names_out())
-        count_vec = np.squeeze(np.asarray(word_count.sum(0)))
-        entity_counts = dict(zip(entity_list, count_vec))
-        sub_cooc_mtx = word_count.T * word_count
+        word_count = self.corpus.sentence_matrix(self._article_rows(articles))
+        count_vec = np.squeeze(np.asarray(word_count.sum(0)), axis=0)
+        entity_counts = {
+            self.entity_list[idx]: count_vec[idx] for idx in np.flatnonzero(count_vec)
+        }
+        sub_cooc_mtx = (word_count.T * word_count).tocsr()
         sub_cooc_mtx.setdiag(0)
-        sub_network = nx.from_numpy_array(sub_cooc_mtx.toarray())
-        labels = {}
-        for idx, label in enumerate(entity_list):
-            labels[idx] = label
-        return entity_counts, nx.relabel_nodes(sub_network, labels)
+        sub_cooc_mtx.eliminate_zeros()
+        return entity_counts, SparseCooc(sub_cooc_mtx, self.term_index, count_vec)
 
     def _fetch_weight_from_network(
-        self, source: str, target: str, network: Union[nx.DiGraph, None] = None
+        self,
+        source: str,
+        target: str,
+        network: Union["SparseCooc", nx.Graph, None] = None,
     ) -> Tuple[int, bool]:
-        if not network:
-            network = self.network
+        if network is None:
+            network = self.cooc
+        if isinstance(network, SparseCooc):
+            return network.weight(source, target)
         try:
             weight = network[source][target]["weight"]
             exist = True
@@ -112,14 +350,80 @@ class CoocAnalyzer:
         return weight, exist
 
 
-def _gilda_ground(query: str, **kwargs) -> Optional[str]:
-    if len(query.split("|")) == 3:
-        return query
+def _resized(matrix: sparse.csr_matrix, n_terms: int) -> sparse.csr_matrix:
+    if matrix.shape != (n_terms, n_terms):
+        matrix = matrix.copy()
+        matrix.resize((n_terms, n_terms))
+    return matrix
+
 
-    matches = gilda.ground(query, **kwargs)
-    if matches:
-        return "|".join(
-            [matches[0].term.entry_name, matches[0].term.db, matches[0].term.id]
+def _batch_cooc(
+    sentence_ptr: np.ndarray, entity_ids: np.ndarray, n_terms: int
+) -> Tuple[sparse.csr_matrix, np.ndarray]:
+    # co-occurrence counts and word counts of a batch of sentences
+    sentence_matrix = count_matrix(sentence_ptr, entity_ids, n_terms)
+    word_count = CoocAnalyzer._multi_entity_rows(sentence_matrix)
+    return (word_count.T * word_count).tocsr(), np.asarray(word_count.sum(0)).ravel()
+
+
+class SparseCooc:
+    # co-occurrence counts kept as a sparse matrix together with a term -> column
+    # index; pairs that never co-occur are not stored
+    def __init__(
+        self,
+        matrix: sparse.spmatrix,
+        term_index: Dict[str, int],
+        counts: Optional[np.ndarray] = None,
+    ) -> None:
+        self.matrix = matrix.tocsr()
+        self.term_index = term_index
+        self.counts = counts  # word count of each term
+
+    @property
+    def terms(self) -> List[str]:
+        terms = [None] * len(self.term_index)
+        for term, idx in self.term_index.items():
+            terms[idx] = term
+        return terms
+
+    def weight(self, source: str, target: str) -> Tuple[int, bool]:
+        # same convention as CoocAnalyzer._fetch_weight_from_network
+        row = self.term_index.get(source)
+        col = self.term_index.get(target)
+        if (row is None) or (col is None):
+            return 1, False
+        weight = self.matrix[row, col]
+        if weight == 0:
+            return 1, False
+        return int(weight), True
+
+    def save(self, path: str) -> None:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        sparse.save_npz(os.path.join(path, "cooc.npz"), self.matrix)
+        np.save(os.path.join(path, "counts.npy"), self.counts)
+        with open(os.path.join(path, "terms.json"), "w") as f:
+            json.dump(self.terms, f)
+
+    @classmethod
+    def load(cls, path: str) -> "SparseCooc":
+        with open(os.path.join(path, "terms.json"), "r") as f:
+            terms = json.load(f)
+        return cls(
+            sparse.load_npz(os.path.join(path, "cooc.npz")),
+            {term: idx for idx, term in enumerate(terms)},
+            np.load(os.path.join(path, "counts.npy")),
         )
-    else:
-        return None
+
+    def gather(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        # co-occurrence counts of the (rows[i], cols[i]) pairs
+        return np.asarray(self.matrix[rows, cols]).ravel()
+
+    def to_networkx(self) -> nx.Graph:
+        network = nx.from_scipy_sparse_array(self.matrix)
+        return nx.relabel_nodes(network, dict(enumerate(self.terms)))
+
+
+def _gilda_ground(query: str, **kwargs) -> Optional[str]:
+    # memoized through the grounding service shared across the package
+    return default_service.ground(query, **kwargs)
@@ -0,0 +1,127 @@
+import json
+import sys
+from types import MappingProxyType
+from typing import Iterable, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+
+def count_matrix(
+    indptr: np.ndarray, entity_ids: np.ndarray, n_terms: int
+) -> sparse.csr_matrix:
+    # (rows x n_terms) counts of the entity ids of each row, where
+    # entity_ids[indptr[i]:indptr[i+1]] are the ids of row i. The arrays are
+    # used as they are (read-only memory maps included) unless an entity occurs
+    # more than once in a row, in which case the counts are summed on a copy
+    indptr = np.asarray(indptr)
+    entity_ids = np.asarray(entity_ids)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(entity_ids), dtype=np.int64), entity_ids, indptr),
+        shape=(len(indptr) - 1, n_terms),
+        copy=False,
+    )
+    if _has_duplicates(indptr, entity_ids, n_terms):
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+    return matrix
+
+
+def _has_duplicates(indptr: np.ndarray, entity_ids: np.ndarray, n_terms: int) -> bool:
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    keys = np.sort(rows * n_terms + entity_ids)
+    return bool(np.any(keys[1:] == keys[:-1]))
+
+
+class EntityVocabulary:
+    # grounded entity strings ("entry_name|db|id") with stable integer ids,
+    # assigned in order of addition; the strings are interned, and ids of
+    # existing entities never change, so that a saved vocabulary keeps the
+    # columns of matrices built in different runs aligned
+    def __init__(self, terms: Iterable[str] = ()) -> None:
+        self._terms = []
+        self._index = {}
+        self.extend(terms)
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._terms)
+
+    def __getitem__(self, idx: int) -> str:
+        return self._terms[idx]
+
+    @property
+    def terms(self) -> List[str]:
+        # id -> entity (not to be modified)
+        return self._terms
+
+    @property
+    def index(self) -> Mapping[str, int]:
+        # read-only, live view of entity -> id
+        return MappingProxyType(self._index)
+
+    def get(self, term: str, default: Optional[int] = None) -> Optional[int]:
+        return self._index.get(term, default)
+
+    def add(self, term: str) -> int:
+        idx = self._index.get(term)
+        if idx is None:
+            idx = len(self._terms)
+            term = sys.intern(term)
+            self._terms.append(term)
+            self._index[term] = idx
+        return idx
+
+    def extend(self, terms: Iterable[str]) -> None:
+        for term in terms:
+            self.add(term)
+
+    def encode(self, entities: Iterable[str], grow: bool = True) -> List[int]:
+        # ids of the entities; unknown entities are added if grow is True and
+        # dropped otherwise
+        if grow:
+            return [self.add(entity) for entity in entities]
+        return [self._index[entity] for entity in entities if entity in self._index]
+
+    def decode(self, ids: Iterable[int]) -> List[str]:
+        return [self._terms[idx] for idx in ids]
+
+    def count_matrix(
+        self, indptr: np.ndarray, entity_ids: np.ndarray
+    ) -> sparse.csr_matrix:
+        # (rows x vocabulary) counts from CSR-style id lists
+        return count_matrix(indptr, entity_ids, len(self))
+
+    def matrix(
+        self, rows: Iterable[Iterable[str]], grow: bool = True
+    ) -> sparse.csr_matrix:
+        # (rows x vocabulary) counts of lists of entities
+        indptr = [0]
+        entity_ids = []
+        for entities in rows:
+            entity_ids.extend(self.encode(entities, grow))
+            indptr.append(len(entity_ids))
+        return self.count_matrix(
+            np.array(indptr, dtype=np.int64), np.array(entity_ids, dtype=np.int32)
+        )
+
+    def sorted(self) -> Tuple["EntityVocabulary", np.ndarray]:
+        # vocabulary in sorted order, and the new id of each current id
+        order = sorted(range(len(self._terms)), key=self._terms.__getitem__)
+        new_ids = np.empty(len(order), dtype=np.int32)
+        new_ids[order] = np.arange(len(order), dtype=np.int32)
+        return EntityVocabulary(self._terms[idx] for idx in order), new_ids
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self._terms, f)
+
+    @classmethod
+    def load(cls, path: str) -> "EntityVocabulary":
+        with open(path, "r") as f:
+            return cls(json.load(f))
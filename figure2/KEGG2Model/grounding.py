@@ -0,0 +1,108 @@
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import gilda
+
+
+class GroundingService:
+    # memoizes Gilda groundings as "entry_name|db|id" strings (or None), keyed on
+    # (query, namespaces, context); least recently used results are dropped once
+    # `maxsize` is exceeded, and the cache can be persisted to a JSON file
+    def __init__(
+        self, maxsize: Optional[int] = 100000, path: Optional[str] = None
+    ) -> None:
+        self.maxsize = maxsize
+        self.path = path
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def _key(
+        query: str,
+        namespaces: Optional[Iterable[str]] = None,
+        context: Optional[str] = None,
+    ) -> Tuple[str, Optional[Tuple[str, ...]], Optional[str]]:
+        return (
+            query,
+            tuple(sorted(namespaces)) if namespaces is not None else None,
+            context,
+        )
+
+    def ground(
+        self,
+        query: str,
+        namespaces: Optional[List[str]] = None,
+        context: Optional[str] = None,
+    ) -> Optional[str]:
+        if len(query.split("|")) == 3:
+            return query
+
+        key = self._key(query, namespaces, context)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        kwargs = {}
+        if namespaces is not None:
+            kwargs["namespaces"] = namespaces
+        if context is not None:
+            kwargs["context"] = context
+        matches = gilda.ground(query, **kwargs)
+        if matches:
+            grounded = "|".join(
+                [matches[0].term.entry_name, matches[0].term.db, matches[0].term.id]
+            )
+        else:
+            grounded = None
+        self._store(key, grounded)
+        return grounded
+
+    def ground_batch(
+        self,
+        queries: Iterable[str],
+        namespaces: Optional[List[str]] = None,
+        context: Optional[str] = None,
+    ) -> Dict[str, Optional[str]]:
+        # grounds every unique query once
+        return {
+            query: self.ground(query, namespaces=namespaces, context=context)
+            for query in dict.fromkeys(queries)
+        }
+
+    def _store(self, key: tuple, grounded: Optional[str]) -> None:
+        self._cache[key] = grounded
+        if self.maxsize is not None:
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def save(self, path: Optional[str] = None) -> None:
+        path = path if path else self.path
+        with open(path, "w") as f:
+            json.dump(
+                [
+                    [query, list(namespaces) if namespaces is not None else None]
+                    + [context, grounded]
+                    for (query, namespaces, context), grounded in self._cache.items()
+                ],
+                f,
+            )
+
+    def load(self, path: str) -> None:
+        with open(path, "r") as f:
+            for query, namespaces, context, grounded in json.load(f):
+                self._store(self._key(query, namespaces, context), grounded)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# shared by CoocAnalyzer and KEGGpathway
+default_service = GroundingService()
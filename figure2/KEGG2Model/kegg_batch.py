@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+
+from .convert_network import iter_text2model, write_text2model
+from .KGML_parser import KEGGpathway
+from .kegg_cache import KEGGCache
+from .kegg_rest import KEGGRestClient
+
+
+def download_kgml(
+    pathway_IDs: List[str],
+    kgml_dir: str,
+    rest_client: Optional[KEGGRestClient] = None,
+    refresh: bool = False,
+) -> Dict[str, dict]:
+    # downloads the KGML files that are not in kgml_dir yet (all of them if
+    # refresh is True); returns pathway ID -> {"path", "status", "seconds"},
+    # with the error message as status of failed downloads
+    rest_client = rest_client if rest_client else KEGGRestClient()
+    if not os.path.exists(kgml_dir):
+        os.makedirs(kgml_dir)
+
+    def download(pathway_ID: str) -> dict:
+        path = os.path.join(kgml_dir, f"{pathway_ID}.xml")
+        start = time.perf_counter()
+        if os.path.exists(path) and not refresh:
+            status = "cached"
+        else:
+            try:
+                kgml = rest_client.get_kgml(pathway_ID)
+            except Exception as e:
+                kgml = None
+                status = f"{type(e).__name__}: {e}"
+            else:
+                status = "downloaded" if kgml else "no KGML available"
+            if kgml:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(kgml)
+                os.replace(path + ".tmp", path)
+        return {
+            "path": path,
+            "status": status,
+            "seconds": time.perf_counter() - start,
+        }
+
+    # the client's rate limit is shared by all threads
+    with ThreadPoolExecutor(max_workers=rest_client.max_workers) as executor:
+        return dict(zip(pathway_IDs, executor.map(download, pathway_IDs)))
+
+
+def convert_pathway(
+    kgml_path: str,
+    outpath: str,
+    cache_path: Optional[str] = None,
+    rate_limit: float = 3.0,
+    visualize: bool = False,
+    base_url: str = "https://rest.kegg.jp",
+) -> dict:
+    # parses, grounds and converts one KGML file into
+    # <outpath>/<pathway>_text2model.txt (and <pathway>.html); runs in a worker
+    # process, so errors are returned with the stage they occurred in
+    pathway_ID = os.path.splitext(os.path.basename(kgml_path))[0]
+    result = {"status": "ok", "outputs": [], "timings": {}}
+    timings = result["timings"]
+    stage = "parse"
+    start = time.perf_counter()
+    cache = KEGGCache(cache_path) if cache_path else None
+    try:
+        p = KEGGpathway(
+            kgml_path,
+            cache=cache,
+            rest_client=KEGGRestClient(base_url, rate_limit=rate_limit),
+        )
+        timings.update(p.timings)
+        result["title"] = p.title
+        result["nodes"] = p.graph.number_of_nodes()
+        result["edges"] = p.graph.number_of_edges()
+
+        stage = "convert"
+        start = time.perf_counter()
+        path = os.path.join(outpath, f"{pathway_ID}_text2model.txt")
+        result["reactions"] = write_text2model(iter_text2model(p), path)
+        result["outputs"].append(path)
+        timings["convert"] = time.perf_counter() - start
+
+        if visualize:
+            stage = "visualize"
+            start = time.perf_counter()
+            path = os.path.join(outpath, f"{pathway_ID}.html")
+            p.visualize(path, show=False, informative=False)
+            result["outputs"].append(path)
+            timings["visualize"] = time.perf_counter() - start
+    except Exception as e:
+        timings.setdefault(stage, time.perf_counter() - start)
+        result.update(status="failed", stage=stage, error=f"{type(e).__name__}: {e}")
+    finally:
+        if cache is not None:
+            cache.close()
+    return result
+
+
+def list_pathways(
+    organism: str,
+    title: Optional[str] = None,
+    rest_client: Optional[KEGGRestClient] = None,
+) -> List[Tuple[str, str]]:
+    # (pathway ID, title) of the maps of an organism, optionally only those
+    # whose title contains `title` (case-insensitive)
+    rest_client = rest_client if rest_client else KEGGRestClient()
+    pathways = rest_client.list_pathways(organism)
+    if title:
+        pathways = [
+            (pathway_ID, name)
+            for pathway_ID, name in pathways
+            if title.lower() in name.lower()
+        ]
+    return pathways
+
+
+def run_batch(
+    pathway_IDs: List[str],
+    outpath: str = "out",
+    kgml_dir: str = "kgml",
+    cache_path: Optional[str] = "kegg_cache.sqlite",
+    workers: int = 4,
+    rate_limit: float = 3.0,
+    visualize: bool = False,
+    refresh: bool = False,
+    base_url: str = "https://rest.kegg.jp",
+) -> dict:
+    # converts the given pathway maps on a process pool and writes the run
+    # manifest (<outpath>/manifest.json, one record per pathway in the given
+    # order); a map that fails in any stage, or crashes its worker process, is
+    # recorded and skipped.
+    # All KGML files are downloaded before the conversion starts, and the
+    # workers share the REST rate limit, so KEGG never sees more than
+    # `rate_limit` requests per second
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
+    manifest = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "workers": workers,
+        "pathways": [],
+    }
+    start = time.perf_counter()
+    downloads = download_kgml(
+        pathway_IDs, kgml_dir, KEGGRestClient(base_url, rate_limit=rate_limit), refresh
+    )
+    manifest["timings"] = {"download": time.perf_counter() - start}
+
+    records = {}
+    for pathway_ID, download in downloads.items():
+        records[pathway_ID] = {
+            "pathway": pathway_ID,
+            "kgml": download["path"],
+            "status": "pending",
+            "outputs": [],
+            "timings": {"download": download["seconds"]},
+        }
+        if download["status"] not in ("cached", "downloaded"):
+            records[pathway_ID].update(
+                status="failed", stage="download", error=download["status"]
+            )
+
+    start = time.perf_counter()
+    pending = [
+        pathway_ID
+        for pathway_ID in pathway_IDs
+        if records[pathway_ID]["status"] == "pending"
+    ]
+
+    def convert(executor: ProcessPoolExecutor, pathway_IDs: List[str]) -> List[str]:
+        # converts the maps on the executor; returns the maps that were lost
+        # because a worker process died
+        futures = {
+            executor.submit(
+                convert_pathway,
+                records[pathway_ID]["kgml"],
+                outpath,
+                cache_path,
+                rate_limit / workers,
+                visualize,
+                base_url,
+            ): pathway_ID
+            for pathway_ID in pathway_IDs
+        }
+        lost = []
+        for future in as_completed(futures):
+            pathway_ID = futures[future]
+            record = records[pathway_ID]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                lost.append(pathway_ID)
+                continue
+            except Exception as e:
+                result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+            record["timings"].update(result.pop("timings", {}))
+            record.update(result)
+            print(f"{pathway_ID}: {record['status']}")
+        return lost
+
+    def convert_isolated(pathway_ID: str) -> None:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            if convert(executor, [pathway_ID]):
+                # the stage the worker was in is not known to the driver
+                records[pathway_ID].update(
+                    status="failed",
+                    stage="worker",
+                    error="the worker process died (e.g. out of memory)",
+                )
+                print(f"{pathway_ID}: failed")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        lost = convert(executor, pending)
+    # a worker that dies (e.g. killed for memory) breaks the pool, which fails
+    # every map that was still queued; these are run again, each in a process
+    # of its own, so that only the map that crashed is recorded as failed
+    if lost:
+        with ThreadPoolExecutor(max_workers=workers) as threads:
+            list(threads.map(convert_isolated, lost))
+    manifest["timings"]["convert"] = time.perf_counter() - start
+
+    manifest["pathways"] = [records[pathway_ID] for pathway_ID in pathway_IDs]
+    manifest["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    manifest["failed"] = [
+        record["pathway"] for record in manifest["pathways"] if record["status"] != "ok"
+    ]
+    manifest_path = os.path.join(outpath, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert KEGG pathway maps to Text2Model files in parallel."
+    )
+    parser.add_argument(
+        "pathways",
+        nargs="+",
+        help="pathway IDs (e.g. hsa04012), or an organism code (e.g. hsa) for all "
+        "of its maps",
+    )
+    parser.add_argument(
+        "--title", help="only maps whose title contains this (e.g. signaling)"
+    )
+    parser.add_argument("--out", default="out")
+    parser.add_argument("--kgml-dir", default="kgml")
+    parser.add_argument("--cache", default="kegg_cache.sqlite")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate-limit", type=float, default=3.0)
+    parser.add_argument("--visualize", action="store_true")
+    parser.add_argument(
+        "--refresh", action="store_true", help="download KGML files again"
+    )
+    args = parser.parse_args()
+
+    if len(args.pathways) == 1 and args.pathways[0].isalpha():
+        pathway_IDs = [
+            pathway_ID
+            for pathway_ID, _ in list_pathways(
+                args.pathways[0], args.title, KEGGRestClient(rate_limit=args.rate_limit)
+            )
+        ]
+    else:
+        pathway_IDs = args.pathways
+    manifest = run_batch(
+        pathway_IDs,
+        outpath=args.out,
+        kgml_dir=args.kgml_dir,
+        cache_path=args.cache,
+        workers=args.workers,
+        rate_limit=args.rate_limit,
+        visualize=args.visualize,
+        refresh=args.refresh,
+    )
+    print(
+        f"{len(pathway_IDs) - len(manifest['failed'])} of {len(pathway_IDs)} "
+        f"pathways converted. Failed: {manifest['failed']}"
+    )
@@ -0,0 +1,124 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, Optional
+
+
+class KEGGCacheMiss(KeyError):
+    pass
+
+
+class KEGGCache:
+    # persistent cache of parsed KEGG REST "/get/" records, keyed by KEGG ID
+    # (e.g. "hsa:1956", "cpd:C00076"); records are stored as JSON strings
+    def __init__(
+        self,
+        path: str = "kegg_cache.sqlite",
+        ttl: Optional[float] = 30 * 24 * 3600,
+        max_entries: Optional[int] = 100000,
+        offline: bool = False,
+        timeout: float = 60.0,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.offline = offline
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # several processes may share the cache file; writers wait up to
+        # `timeout` seconds for the database lock
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "kegg_id TEXT PRIMARY KEY, record TEXT NOT NULL, "
+            "fetched REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, kegg_ID: str) -> bool:
+        return bool(self.get_many([kegg_ID]))
+
+    def get(self, kegg_ID: str) -> Optional[dict]:
+        return self.get_many([kegg_ID]).get(kegg_ID)
+
+    def get_many(self, kegg_IDs: Iterable[str]) -> Dict[str, dict]:
+        # returns the cached records for the given IDs; missing & expired IDs are
+        # left out, except in offline mode where expired records are still served
+        kegg_IDs = list(dict.fromkeys(kegg_IDs))
+        now = time.time()
+        found = {}
+        for i in range(0, len(kegg_IDs), 500):  # stay below SQLite variable limit
+            chunk = kegg_IDs[i : i + 500]
+            rows = self._conn.execute(
+                "SELECT kegg_id, record, fetched FROM entries WHERE kegg_id IN "
+                f"({','.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            for kegg_ID, record, fetched in rows:
+                if (
+                    (not self.offline)
+                    and (self.ttl is not None)
+                    and (now - fetched > self.ttl)
+                ):
+                    continue
+                found[kegg_ID] = json.loads(record)
+        if found:
+            self._conn.executemany(
+                "UPDATE entries SET accessed = ? WHERE kegg_id = ?",
+                [(now, kegg_ID) for kegg_ID in found],
+            )
+            self._conn.commit()
+        return found
+
+    def require(self, kegg_IDs: Iterable[str]) -> Dict[str, dict]:
+        # same as get_many, but raises KEGGCacheMiss if any ID is missing
+        kegg_IDs = list(kegg_IDs)
+        found = self.get_many(kegg_IDs)
+        missing = [kegg_ID for kegg_ID in kegg_IDs if kegg_ID not in found]
+        if missing:
+            raise KEGGCacheMiss(f"KEGG entries not found in cache: {missing}")
+        return found
+
+    def put_many(self, records: Dict[str, dict]) -> None:
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO entries (kegg_id, record, fetched, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (kegg_ID, json.dumps(record), now, now)
+                for kegg_ID, record in records.items()
+            ],
+        )
+        self._conn.commit()
+        self._evict()
+
+    def _evict(self) -> None:
+        # drop expired records, then the least recently used ones above max_entries
+        if self.ttl is not None:
+            self._conn.execute(
+                "DELETE FROM entries WHERE fetched < ?", (time.time() - self.ttl,)
+            )
+        if self.max_entries is not None:
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM entries WHERE kegg_id IN ("
+                    "SELECT kegg_id FROM entries ORDER BY accessed LIMIT ?)",
+                    (excess,),
+                )
+        self._conn.commit()
+
+    def clear(self) -> None:
+        self._conn.execute("DELETE FROM entries")
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
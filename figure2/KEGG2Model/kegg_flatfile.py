@@ -0,0 +1,92 @@
+import codecs
+import re
+from typing import Iterable, Iterator, List, Optional, Union
+
+_ENTRY = re.compile(r"ENTRY\s+(\w+)\s")
+_FIELD = re.compile(r"(\S+)\s*(.*)")
+_DBLINK = re.compile(r"(.+):\s+(\w+)")
+_PAIR = re.compile(r"(\S+)\s+(.*)")
+
+
+class FlatFileParser:
+    # incremental parser for KEGG flat files (responses of the "/get/" API);
+    # feed() accepts arbitrary chunks and returns the entries completed by "///"
+    def __init__(self, encoding: str = "utf-8") -> None:
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._buffer = ""
+        self._entry = None
+        self._field = None
+
+    def feed(self, chunk: Union[bytes, str]) -> List[dict]:
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk)
+        lines = (self._buffer + chunk).split("\n")
+        self._buffer = lines.pop()  # last line may be incomplete
+        output = []
+        for line in lines:
+            entry = self._parse_line(line.rstrip("\r"))
+            if entry is not None:
+                output.append(entry)
+        return output
+
+    def close(self) -> List[dict]:
+        rest = self._buffer + self._decoder.decode(b"", final=True)
+        self._buffer = ""
+        output = []
+        if rest:
+            entry = self._parse_line(rest.rstrip("\r"))
+            if entry is not None:
+                output.append(entry)
+        return output
+
+    def _parse_line(self, line: str) -> Optional[dict]:
+        if line.startswith("///"):
+            entry, self._entry, self._field = self._entry, None, None
+            return entry
+        if not line.strip():
+            return None
+        if line[0].isspace():  # continuation of the previous field
+            value = line.strip()
+        else:
+            if line.startswith("ENTRY"):
+                self._entry = {"KEGGID": _ENTRY.search(line).group(1)}
+            self._field, value = _FIELD.match(line).groups()
+        if self._entry is None:
+            return None
+        self._add_value(self._field, value)
+        return None
+
+    def _add_value(self, field: str, value: str) -> None:
+        entry = self._entry
+        if field == "SYMBOL":
+            if "symbols" not in entry:
+                entry["symbols"] = value.split(", ")
+        elif field == "NAME":
+            if "name" not in entry:
+                entry["name"] = value.strip(";")
+                entry["names"] = []
+            entry["names"].append(value.strip(";").strip())
+        elif field == "DBLINKS":
+            db_link = _DBLINK.search(value)
+            if db_link:
+                entry.setdefault("db_links", {})[db_link.group(1)] = db_link.group(2)
+        elif field == "ORTHOLOGY":
+            pair = _PAIR.match(value)
+            if pair:
+                entry.setdefault("orthology", {})[pair.group(1)] = pair.group(2)
+        elif field == "PATHWAY":
+            pair = _PAIR.match(value)
+            if pair:
+                entry.setdefault("pathways", {})[pair.group(1)] = pair.group(2)
+
+
+def iter_flat_file(chunks: Iterable[Union[bytes, str]]) -> Iterator[dict]:
+    # yields entries as soon as their closing "///" has been read
+    parser = FlatFileParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def parse_flat_file(text: Union[bytes, str]) -> List[dict]:
+    return list(iter_flat_file([text]))
@@ -0,0 +1,141 @@
+import http.client
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from .kegg_flatfile import iter_flat_file
+
+
+class KEGGRestError(Exception):
+    pass
+
+
+class KEGGRestClient:
+    # fetches KEGG "/get/" entries in batches, keeping several batches in flight
+    # while never exceeding `rate_limit` requests per second (KEGG asks for <= 3)
+    def __init__(
+        self,
+        base_url: str = "https://rest.kegg.jp",
+        batch_size: int = 10,
+        max_workers: int = 3,
+        rate_limit: float = 3.0,
+        retries: int = 3,
+        backoff: float = 1.0,
+        timeout: float = 30.0,
+        chunk_size: int = 65536,
+    ) -> None:
+        url = urllib.parse.urlsplit(base_url)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.base_path = url.path.rstrip("/")
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._local = threading.local()  # one keep-alive connection per thread
+        self._rate_lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def get_entries(self, kegg_IDs: List[str]) -> List[dict]:
+        batches = [
+            kegg_IDs[i : i + self.batch_size]
+            for i in range(0, len(kegg_IDs), self.batch_size)
+        ]
+        if len(batches) <= 1 or self.max_workers <= 1:
+            results = [self._fetch_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(self._fetch_batch, batches))
+        return [entry for result in results for entry in result]
+
+    def get_kgml(self, pathway_ID: str) -> Optional[bytes]:
+        # KGML of a pathway map (e.g. "hsa04012"); None if there is none
+        kgml = self._request(
+            f"/get/{pathway_ID}/kgml", lambda response: response.read()
+        )
+        return kgml if kgml else None
+
+    def list_pathways(self, organism: str) -> List[Tuple[str, str]]:
+        # (pathway ID, title) of all maps of an organism (e.g. "hsa")
+        lines = self._request(
+            f"/list/pathway/{organism}",
+            lambda response: response.read().decode("utf-8").splitlines(),
+        )
+        pathways = []
+        for line in lines:
+            if "\t" in line:
+                pathway_ID, title = line.split("\t", 1)
+                pathways.append((pathway_ID.split(":")[-1], title))
+        return pathways
+
+    def _fetch_batch(self, id_list: List[str]) -> List[dict]:
+        # entries are parsed while the response is being received
+        return self._request(
+            "/get/" + "+".join(id_list),
+            lambda response: list(iter_flat_file(self._iter_chunks(response))),
+        )
+
+    def _iter_chunks(self, response: http.client.HTTPResponse) -> Iterator[bytes]:
+        while True:
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def _request(
+        self, path: str, handler: Callable[[http.client.HTTPResponse], List]
+    ) -> List:
+        # GET with exponential-backoff retries; a 404 means that none of the
+        # requested IDs exist, which is returned as an empty result
+        for attempt in range(self.retries):
+            self._wait_for_slot()
+            try:
+                conn = self._connection()
+                conn.request("GET", self.base_path + path)
+                response = conn.getresponse()
+                if response.status == 200:
+                    return handler(response)
+                response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self._reset_connection()
+                error = e
+            else:
+                if response.status == 404:
+                    return []
+                error = KEGGRestError(f"HTTP {response.status} for {path}")
+                if response.status < 500 and response.status not in (403, 429):
+                    raise error
+            if attempt < self.retries - 1:
+                time.sleep(self.backoff * 2**attempt)
+        raise error
+
+    def _wait_for_slot(self) -> None:
+        if not self.rate_limit:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.rate_limit
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.scheme == "https":
+                conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _reset_connection(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,336 @@
+import array
+import gzip
+import json
+import os
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from scipy import sparse
+
+from .entity_vocabulary import EntityVocabulary
+
+# files of the binary corpus format; entity_ids[sentence_ptr[i]:sentence_ptr[i+1]]
+# are the entities of sentence i, and sentences article_ptr[j]:article_ptr[j+1]
+# belong to article j
+_VOCABULARY = "vocabulary.json"
+_ARRAYS = ["pmids", "article_ptr", "sentence_ptr", "entity_ids"]
+# inverted index, saved with the corpus so that it is memory-mapped as well;
+# postings[postings_ptr[i]:postings_ptr[i+1]] are the articles of entity i
+_INDEX = ["postings_ptr", "postings"]
+# manifest of the sharded output of pubtator/process_data.py
+_MANIFEST = "manifest.jsonl"
+
+
+class PubTatorCorpus:
+    # processed PubTator data as an entity vocabulary plus CSR-style integer
+    # arrays; loaded corpora are memory-mapped (read-only)
+    def __init__(
+        self,
+        vocabulary: Union[EntityVocabulary, List[str]],
+        pmids: np.ndarray,
+        article_ptr: np.ndarray,
+        sentence_ptr: np.ndarray,
+        entity_ids: np.ndarray,
+    ) -> None:
+        if not isinstance(vocabulary, EntityVocabulary):
+            vocabulary = EntityVocabulary(vocabulary)
+        self.vocabulary = vocabulary
+        self.pmids = pmids
+        self.article_ptr = article_ptr
+        self.sentence_ptr = sentence_ptr
+        self.entity_ids = entity_ids
+        self._postings = None
+
+    def __len__(self) -> int:
+        return len(self.article_ptr) - 1
+
+    @property
+    def n_sentences(self) -> int:
+        return len(self.sentence_ptr) - 1
+
+    @classmethod
+    def from_records(
+        cls,
+        records: List[dict],
+        vocabulary: Optional[Union[EntityVocabulary, List[str]]] = None,
+    ) -> "PubTatorCorpus":
+        # records: [{"pmid": ..., "entities": [[entity, ...], ...]}, ...]
+        # Without a vocabulary, the entities are numbered in sorted order;
+        # otherwise a copy of it is extended with the new entities
+        if vocabulary is None:
+            vocabulary = EntityVocabulary(
+                sorted(
+                    {
+                        entity
+                        for data in records
+                        for entities in data["entities"]
+                        for entity in entities
+                    }
+                )
+            )
+        else:
+            vocabulary = EntityVocabulary(vocabulary)
+        article_ptr = [0]
+        sentence_ptr = [0]
+        entity_ids = []
+        for data in records:
+            for entities in data["entities"]:
+                entity_ids.extend(vocabulary.encode(entities))
+                sentence_ptr.append(len(entity_ids))
+            article_ptr.append(len(sentence_ptr) - 1)
+        return cls(
+            vocabulary,
+            np.array([str(data.get("pmid", "")) for data in records]),
+            np.array(article_ptr, dtype=np.int64),
+            np.array(sentence_ptr, dtype=np.int64),
+            np.array(entity_ids, dtype=np.int32),
+        )
+
+    @classmethod
+    def from_shards(
+        cls,
+        path: str,
+        min_sentences: int = 2,
+        vocabulary: Optional[Union[EntityVocabulary, List[str]]] = None,
+    ) -> "PubTatorCorpus":
+        # streams the JSON Lines shards written by pubtator/process_data.py;
+        # only the integer arrays are kept in memory, not the parsed records.
+        # If vocabulary is given, its order is kept and new entities are appended
+        sort = vocabulary is None
+        vocabulary = EntityVocabulary(vocabulary if vocabulary is not None else [])
+        pmids = []
+        article_ptr = array.array("q", [0])
+        sentence_ptr = array.array("q", [0])
+        entity_ids = array.array("i")
+        for data in iter_shard_records(path):
+            if len(data["entities"]) < min_sentences:
+                continue
+            for entities in data["entities"]:
+                entity_ids.extend(vocabulary.encode(entities))
+                sentence_ptr.append(len(entity_ids))
+            article_ptr.append(len(sentence_ptr) - 1)
+            pmids.append(str(data.get("pmid", "")))
+        entity_ids = np.frombuffer(entity_ids, dtype=np.int32)
+        if sort:
+            # renumber the entities in sorted order, as from_records does
+            vocabulary, new_ids = vocabulary.sorted()
+            entity_ids = new_ids[entity_ids]
+        return cls(
+            vocabulary,
+            np.array(pmids),
+            np.frombuffer(article_ptr, dtype=np.int64),
+            np.frombuffer(sentence_ptr, dtype=np.int64),
+            entity_ids,
+        )
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "PubTatorCorpus":
+        vocabulary = EntityVocabulary.load(os.path.join(path, _VOCABULARY))
+        arrays = [
+            np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None)
+            for name in _ARRAYS
+        ]
+        corpus = cls(vocabulary, *arrays)
+        # corpora saved without the index build it when it is first used
+        if all(os.path.isfile(os.path.join(path, name + ".npy")) for name in _INDEX):
+            corpus._postings = tuple(
+                np.load(
+                    os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None
+                )
+                for name in _INDEX
+            )
+        return corpus
+
+    def save(self, path: str) -> None:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.vocabulary.save(os.path.join(path, _VOCABULARY))
+        for name in _ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        for name, array in zip(_INDEX, self.postings()):
+            np.save(os.path.join(path, name + ".npy"), array)
+
+    @staticmethod
+    def is_corpus(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, _VOCABULARY))
+
+    @staticmethod
+    def is_shard_store(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, _MANIFEST))
+
+    def entities(self, article: int) -> List[List[str]]:
+        # entities of each sentence of an article, as in pubtator_data.json
+        output = []
+        for sent in range(self.article_ptr[article], self.article_ptr[article + 1]):
+            ids = self.entity_ids[self.sentence_ptr[sent] : self.sentence_ptr[sent + 1]]
+            output.append(self.vocabulary.decode(ids))
+        return output
+
+    def iter_batches(self, batch_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        # (sentence_ptr, entity_ids) of consecutive batches of batch_size
+        # sentences; only the slices of a batch are read from the memory map
+        for start in range(0, self.n_sentences, batch_size):
+            end = min(start + batch_size, self.n_sentences)
+            sentence_ptr = np.array(self.sentence_ptr[start : end + 1])
+            entity_ids = np.array(self.entity_ids[sentence_ptr[0] : sentence_ptr[-1]])
+            yield sentence_ptr - sentence_ptr[0], entity_ids
+
+    def sentence_matrix(self, rows: Optional[np.ndarray] = None) -> sparse.csr_matrix:
+        # (sentences x vocabulary) word counts of all or the given sentences
+        if rows is None:
+            return self.vocabulary.count_matrix(self.sentence_ptr, self.entity_ids)
+        starts = np.asarray(self.sentence_ptr[rows])
+        lengths = np.asarray(self.sentence_ptr[rows + 1]) - starts
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return self.vocabulary.count_matrix(indptr, self.entity_ids[positions])
+
+    def postings(self) -> Tuple[np.ndarray, np.ndarray]:
+        # (postings_ptr, postings): the sorted articles of each entity
+        if self._postings is None:
+            n_articles = max(len(self), 1)
+            article_of_sentence = np.repeat(
+                np.arange(len(self), dtype=np.int64), np.diff(self.article_ptr)
+            )
+            keys = np.unique(
+                np.asarray(self.entity_ids, dtype=np.int64) * n_articles
+                + np.repeat(article_of_sentence, np.diff(self.sentence_ptr))
+            )
+            postings_ptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(keys // n_articles, minlength=len(self.vocabulary)),
+                out=postings_ptr[1:],
+            )
+            dtype = np.int32 if n_articles <= np.iinfo(np.int32).max else np.int64
+            self._postings = (postings_ptr, (keys % n_articles).astype(dtype))
+        return self._postings
+
+
+def iter_sentence_batches(
+    records: Iterable[dict],
+    vocabulary: EntityVocabulary,
+    batch_size: int,
+    grow: bool = True,
+    min_sentences: int = 0,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    # (sentence_ptr, entity_ids) of batches of about batch_size sentences of the
+    # records (whole articles are kept together); entities are mapped through
+    # the vocabulary, which is extended in place with new entities if grow is
+    # True (otherwise they are dropped)
+    sentence_ptr = array.array("q", [0])
+    entity_ids = array.array("i")
+    for data in records:
+        if len(data["entities"]) < min_sentences:
+            continue
+        for entities in data["entities"]:
+            entity_ids.extend(vocabulary.encode(entities, grow))
+            sentence_ptr.append(len(entity_ids))
+        if len(sentence_ptr) > batch_size:
+            yield np.array(sentence_ptr, dtype=np.int64), np.array(entity_ids)
+            sentence_ptr = array.array("q", [0])
+            entity_ids = array.array("i")
+    if len(sentence_ptr) > 1:
+        yield np.array(sentence_ptr, dtype=np.int64), np.array(entity_ids)
+
+
+def read_manifest(path: str) -> List[dict]:
+    # records of the shard manifest of an output directory of
+    # pubtator/process_data.py, up to the last complete line; undecodable lines
+    # are skipped
+    records = []
+    manifest_path = os.path.join(path, _MANIFEST)
+    if not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path, "r") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break  # partially written line of an interrupted run
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def read_shard(path: str) -> Iterator[dict]:
+    # records of a JSON Lines shard (one article per line)
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _read_shard(path: str, shard: Optional[str], min_sentences: int) -> dict:
+    # pmid -> entities of the articles with at least min_sentences sentences
+    if not shard:
+        return {}
+    return {
+        data["pmid"]: data["entities"]
+        for data in read_shard(os.path.join(path, shard))
+        if len(data["entities"]) >= min_sentences
+    }
+
+
+def iter_shard_records(path: str) -> Iterator[dict]:
+    # records of the latest shard of each member, in the order of the shard paths
+    shards = {}
+    for record in read_manifest(path):
+        key = (record["tar"], record.get("member"))
+        if record["status"] == "done":
+            shards[key] = record.get("shard")
+        elif record["status"] == "removed":
+            shards.pop(key, None)
+    for shard in sorted(shard for shard in shards.values() if shard):
+        yield from read_shard(os.path.join(path, shard))
+
+
+def shard_changes(
+    path: str, start: int = 0, min_sentences: int = 2
+) -> Tuple[List[dict], List[dict], int]:
+    # articles removed from and added to the corpus by the manifest records from
+    # line `start` on; a changed article appears in both lists. Also returns the
+    # line to start from next time
+    records = read_manifest(path)
+    removed = []
+    added = []
+    for record in records[start:]:
+        if record["status"] not in ("done", "removed"):
+            continue
+        old = _read_shard(path, record.get("replaces"), min_sentences)
+        new = _read_shard(path, record.get("shard"), min_sentences)
+        for pmid, entities in old.items():
+            if new.get(pmid) != entities:
+                removed.append({"pmid": pmid, "entities": entities})
+        for pmid, entities in new.items():
+            if old.get(pmid) != entities:
+                added.append({"pmid": pmid, "entities": entities})
+    return removed, added, len(records)
+
+
+def convert_pubtator_json(json_path: str, out_path: str) -> PubTatorCorpus:
+    # converts pubtator_data.json(.gz), or a directory of shards written by
+    # pubtator/process_data.py, into the binary corpus format
+    if PubTatorCorpus.is_shard_store(json_path):
+        corpus = PubTatorCorpus.from_shards(json_path)
+        corpus.save(out_path)
+        return PubTatorCorpus.load(out_path)
+    if json_path.endswith(".gz"):
+        with gzip.open(json_path, "rb") as f:
+            records = json.load(f)
+    else:
+        with open(json_path, "r") as f:
+            records = json.load(f)
+    corpus = PubTatorCorpus.from_records(records)
+    corpus.save(out_path)
+    return PubTatorCorpus.load(out_path)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print(
+            "usage: python -m KEGG2Model.pubtator_corpus pubtator_data.json.gz out_dir"
+        )
+        sys.exit(1)
+    convert_pubtator_json(sys.argv[1], sys.argv[2])
@@ -1,9 +1,10 @@
 import os
 import urllib.request
 
-from KEGG2Model.convert_network import to_text2model
+from KEGG2Model.convert_network import iter_text2model, to_text2model, write_text2model
 from KEGG2Model.cooccurrence_analysis import CoocAnalyzer
 from KEGG2Model.KGML_parser import KEGGpathway
+from KEGG2Model.kegg_cache import KEGGCache
 from KEGG2Model.weight_visualizer import weightVis
 
 # download KGML file of Human ErbB signaling pathway (hsa04012)
@@ -20,17 +21,20 @@ if not os.path.exists(outpath):
 
 # process & visualize KGML file
 print("Processing KGML file of Human ErbB signaling pathway (hsa04012)")
-p = KEGGpathway("hsa04012.xml")
+cache = KEGGCache("kegg_cache.sqlite")
+p = KEGGpathway("hsa04012.xml", cache=cache)
 print("Writing visualization results to hsa04012.html")
 p.visualize(os.path.join(outpath, "hsa04012.html"), show=False, informative=False)
 
 # convert KGML file to Text2Model
 print("Converting KGML file to Text2Model")
-graph, reactions = to_text2model(p)
-# output Text2Model file
+# reactions are written to the Text2Model file as they are generated
 print("Writing Text2Model file to hsa04012_text2model.txt")
-with open(os.path.join(outpath, "hsa04012_text2model.txt"), "w") as f:
-    f.write(reactions)
+write_text2model(iter_text2model(p), os.path.join(outpath, "hsa04012_text2model.txt"))
+# a map merged on its own gives the same model as the map itself, so models of
+# merged maps can be compared species by species with single-map models
+merged = KEGGpathway(["hsa04012.xml"], cache=cache)
+assert to_text2model(merged)[1] == to_text2model(p)[1]
 
 # load pubtator data
 print("Loading pubtator data from pubtator_data.json.gz")
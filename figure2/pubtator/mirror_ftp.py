@@ -0,0 +1,227 @@
+import argparse
+import calendar
+import ftplib
+import hashlib
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class MirrorError(Exception):
+    pass
+
+
+def _parse_ftp_time(value: str) -> int:
+    # "YYYYMMDDHHMMSS[.sss]" (UTC) of MLSD and MDTM
+    return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+
+
+class FTPMirror:
+    # mirrors the files of a remote FTP directory into a local directory with a
+    # small pool of connections. Partial downloads (*.part) are resumed with
+    # REST while the remote file is unchanged (its size and mtime are kept in
+    # *.part.remote), files with the remote size and mtime are skipped, and
+    # downloads are verified against the remote size (and the md5 sum, where
+    # the server publishes a <file>.md5 next to the file)
+    def __init__(
+        self,
+        host: str,
+        remote_dir: str,
+        local_dir: str,
+        workers: int = 3,
+        port: int = 21,
+        user: str = "anonymous",
+        passwd: str = "",
+        retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 60.0,
+        blocksize: int = 1 << 20,
+    ) -> None:
+        self.host = host
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        self.workers = workers
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.blocksize = blocksize
+        self._pool = queue.LifoQueue()  # idle logged-in connections
+
+    def _connect(self) -> ftplib.FTP:
+        ftp = ftplib.FTP()
+        ftp.connect(self.host, self.port, timeout=self.timeout)
+        ftp.login(self.user, self.passwd)
+        ftp.cwd(self.remote_dir)
+        ftp.voidcmd("TYPE I")  # SIZE and REST are only reliable in binary mode
+        return ftp
+
+    @contextmanager
+    def _connection(self):
+        # borrows an idle connection (or opens a new one); connections that
+        # raised an error are closed instead of being returned to the pool
+        try:
+            ftp = self._pool.get_nowait()
+        except queue.Empty:
+            ftp = self._connect()
+        try:
+            yield ftp
+        except BaseException:
+            ftp.close()
+            raise
+        self._pool.put(ftp)
+
+    def close(self) -> None:
+        while True:
+            try:
+                ftp = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+    def list_remote(self) -> dict:
+        # file name -> (size, mtime) of the remote directory
+        with self._connection() as ftp:
+            try:
+                return {
+                    name: (int(facts["size"]), _parse_ftp_time(facts["modify"]))
+                    for name, facts in ftp.mlsd(facts=["type", "size", "modify"])
+                    if facts.get("type") == "file"
+                }
+            except ftplib.error_perm:
+                pass  # no MLSD support
+            files = {}
+            for name in ftp.nlst():
+                try:
+                    size = ftp.size(name)
+                except ftplib.error_perm:
+                    continue  # directory
+                mtime = _parse_ftp_time(ftp.sendcmd("MDTM " + name)[4:])
+                files[name] = (size, mtime)
+            return files
+
+    def is_current(self, name: str, size: int, mtime: int) -> bool:
+        path = os.path.join(self.local_dir, name)
+        return (
+            os.path.isfile(path)
+            and os.path.getsize(path) == size
+            and int(os.path.getmtime(path)) == mtime
+        )
+
+    def _remote_md5(self, name: str) -> str:
+        lines = []
+        with self._connection() as ftp:
+            ftp.retrlines("RETR " + name + ".md5", lines.append)
+        # "MD5(<name>)= <sum>" or "<sum>  <name>"
+        text = " ".join(lines)
+        if "=" in text:
+            return text.split("=")[-1].strip().lower()
+        return text.split()[0].lower()
+
+    @staticmethod
+    def _md5(path: str) -> str:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def download(self, name: str, size: int, mtime: int, md5: bool = False) -> str:
+        # returns "skipped" or "downloaded"; raises MirrorError once all retries
+        # have failed. A partial file is kept between attempts (and runs), and
+        # the transfer is resumed from its current size
+        path = os.path.join(self.local_dir, name)
+        if self.is_current(name, size, mtime):
+            return "skipped"
+        part_path = path + ".part"
+        # the remote size and mtime a partial file belongs to; a partial of a
+        # since replaced remote file is discarded instead of being resumed
+        stamp_path = part_path + ".remote"
+        stamp = f"{size} {mtime}"
+        if os.path.exists(part_path):
+            current = None
+            if os.path.exists(stamp_path):
+                with open(stamp_path, "r") as f:
+                    current = f.read().strip()
+            if current != stamp:
+                os.remove(part_path)
+        with open(stamp_path, "w") as f:
+            f.write(stamp)
+        for attempt in range(self.retries):
+            try:
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                if offset > size:
+                    os.remove(part_path)
+                    offset = 0
+                if offset < size:
+                    with self._connection() as ftp, open(part_path, "ab") as f:
+                        ftp.retrbinary(
+                            "RETR " + name,
+                            f.write,
+                            blocksize=self.blocksize,
+                            rest=offset if offset else None,
+                        )
+                elif not os.path.exists(part_path):
+                    open(part_path, "wb").close()  # empty file
+                received = os.path.getsize(part_path)
+                if received != size:
+                    raise MirrorError(f"{name}: received {received} of {size} bytes")
+                if md5 and self._md5(part_path) != self._remote_md5(name):
+                    os.remove(part_path)
+                    raise MirrorError(f"{name}: md5 mismatch")
+                os.replace(part_path, path)
+                os.remove(stamp_path)
+                os.utime(path, (mtime, mtime))
+                return "downloaded"
+            except (MirrorError,) + ftplib.all_errors as e:
+                error = e
+                if attempt < self.retries - 1:
+                    time.sleep(self.backoff * 2**attempt)
+        raise MirrorError(f"Failed to download {name}: {error}")
+
+    def mirror(self, names: list or None = None) -> dict:
+        # downloads the given (default: all) remote files in parallel; returns
+        # file name -> "skipped", "downloaded" or the error message
+        if not os.path.exists(self.local_dir):
+            os.makedirs(self.local_dir)
+        remote = self.list_remote()
+        if names is None:
+            names = sorted(remote)
+
+        def download(name: str) -> str:
+            size, mtime = remote[name]
+            try:
+                return self.download(name, size, mtime, md5=name + ".md5" in remote)
+            except MirrorError as e:
+                return str(e)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return dict(zip(names, executor.map(download, names)))
+        finally:
+            self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Mirror a remote FTP directory (resumable, parallel, verified)."
+    )
+    parser.add_argument("host")
+    parser.add_argument("remote_dir")
+    parser.add_argument("local_dir")
+    parser.add_argument("--port", type=int, default=21)
+    parser.add_argument("--workers", type=int, default=3)
+    args = parser.parse_args()
+
+    results = FTPMirror(
+        args.host, args.remote_dir, args.local_dir, workers=args.workers, port=args.port
+    ).mirror()
+    for name, status in results.items():
+        print(f"{name}: {status}")
@@ -1,20 +1,17 @@
-from ftplib import FTP
-import os
+from mirror_ftp import FTPMirror
 
-if not os.path.exists("data"):
-    os.makedirs("data")
-
-# download data from PubTator Central ftp server
+# download data from PubTator Central ftp server; partial downloads are resumed,
+# and archives whose size and mtime are unchanged (e.g. from a previous
+# release) are skipped, so rerunning this script only fetches what is missing
 url = "ftp.ncbi.nlm.nih.gov"
 path = "/pub/lu/PubTatorCentral/PubTatorCentral_BioCXML/"
 
-ftp = FTP(url)
-ftp.login()
-ftp.cwd(path)
-
-filenames = ftp.nlst()
+results = FTPMirror(url, path, "data", workers=3).mirror()
 
-for filename in filenames:
-    with open(os.path.join("data", filename), "wb") as f:
-        ftp.retrbinary("RETR " + filename, f.write)
-ftp.quit()
+failed = [
+    name for name, status in results.items() if status not in ("skipped", "downloaded")
+]
+for name in failed:
+    print(results[name])
+if failed:
+    print(f"{len(failed)} files failed. Rerun to resume them.")
@@ -1,18 +1,34 @@
-import glob
+import argparse
+import copy
+import gzip
+import hashlib
 import json
 import os
-import pickle
+import shutil
 import sys
 import tarfile
-import xml.etree.cElementTree as ET
+import tempfile
+import traceback
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
 
 import gilda
 import numpy as np
 import spacy
 
+# the manifest and shard readers are shared with KEGG2Model
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from KEGG2Model.pubtator_corpus import iter_shard_records, read_manifest, read_shard
 
-def _gilda_ground(query: str, **kwargs) -> str or None:
-    matches = gilda.ground(query, **kwargs)
+nlp = None  # spacy model, loaded once per worker process
+grounding_cache = None  # GroundingCache, one per worker process
+pipe_options = {"batch_size": 256, "n_process": 1}  # options of nlp.pipe
+documents_per_chunk = 100  # number of documents segmented together
+
+
+def _format_grounding(matches: list) -> str or None:
     if matches:
         return "|".join(
             [matches[0].term.entry_name, matches[0].term.db, matches[0].term.id]
@@ -22,198 +38,655 @@ def _gilda_ground(query: str, **kwargs) -> str or None:
         return None
 
 
-if __name__ == "__main__":
-    datapath = "./data"  # location of pubtator tar files
-
-    # load spacy model
-    nlp = spacy.load("en_core_sci_sm")
-
-    # get list of tar files to process
-    tar_list = os.listdir(datapath)
-
-    # process each tar file
-    for tar in tar_list:
-        # get list of xml files in tar file
-        with tarfile.open(os.path.join(datapath, tar), "r") as f:
-            xml_list = f.getnames()
-        tarpath = os.path.join(datapath, tar)
-        for xml_name in xml_list:
-            basename = os.path.basename(xml_name)
-            outpath = "./pubtator_processed"
-
-            # os.environ["PYSTOW_HOME"] = "./pystow_data"
-
-            with tarfile.open(tarpath, "r") as f:
-                with f.extractfile(xml_name) as biocxml:
-                    try:
-                        root = ET.parse(biocxml).getroot()
-                    except ET.ParseError:
-                        print("Bad XML file")
-                        sys.exit(1)
-
-            ids = []
-            titles = []
-            journals = []
-            sentence_list = []
-            entity_list = []
-            span_list = []
-            for document in root.findall("./document"):
-                id = document.find("./id").text
-                # check if pmcid if the id is a pmcid
-                pmcid = document.find("./passage/infon[@key='article-id_pmc']")
-                if pmcid:
-                    pmcid = pmcid.text
-                if pmcid == id:
-                    id = "PMC" + id
-                title = document.find("./passage/text").text
-                journal = document.find("./passage/infon[@key='journal']")
-                if journal is not None:
-                    journal = journal.text.split(";")[0]
-                else:
-                    journal = "n/a"
-
-                sentences = []
-                entities = []
-                spans = []
-                for passage in document.findall("./passage"):
-                    locations = []
-                    annotations = []
-                    lengths = []
-                    for annotation in passage.findall("./annotation"):
-                        loc = int(annotation.find("./location").attrib["offset"])
-                        length = int(annotation.find("./location").attrib["length"])
-                        name = annotation.find("./text").text
-                        locations.append(loc)
-                        annotations.append(name)
-                        lengths.append(length)
-                    locations = np.array(locations)
-                    if (
-                        len(annotations) > 0
-                    ):  # checking if there are any annotations in the passage
-                        passage_offset = int(passage.find("./offset").text)
-                        text = passage.find("./text").text
-                        doc = nlp(text)
-                        for sent in doc.sents:
-                            offset = sent.start_char + passage_offset
-                            length = len(sent.text)
-                            anno_inside = list(
-                                *np.where(
-                                    (locations >= offset)
-                                    & (locations < offset + length)
-                                )
-                            )
-                            if (
-                                len(anno_inside) > 0
-                            ):  # checking if there are any annotations in the sentence
-                                normalized_names = []
-                                in_spans = []
-                                for idx in anno_inside:
-                                    normalized = _gilda_ground(
-                                        annotations[idx], context=sent.text
-                                    )
-                                    if normalized:
-                                        normalized_names.append(normalized)
-                                        start = locations[idx] - offset
-                                        end = start + lengths[idx]
-                                        in_spans.append((start, end))
-                                if (
-                                    len(normalized_names) > 0
-                                ):  # checking if the normalization was successful
-                                    sentences.append(sent.text)
-                                    entities.append(normalized_names)
-                                    spans.append(in_spans)
-                ids.append(id)
-                titles.append(title)
-                journals.append(journal)
-                sentence_list.append(sentences)
-                entity_list.append(entities)
-                span_list.append(spans)
-
-            if not os.path.exists(outpath):
-                os.mkdir(outpath)
-
-            if len(ids) != 0:
-                # only save pmid and entities for co-occurrence analysis
-                with open(os.path.join(outpath, basename + "_id.pkl"), "wb") as output:
-                    pickle.dump(ids, output)
-                # with open(
-                #     os.path.join(outpath, basename + "_title.pkl"), "wb"
-                # ) as output:
-                #     pickle.dump(titles, output)
-                # with open(
-                #     os.path.join(outpath, basename + "_journal.pkl"), "wb"
-                # ) as output:
-                #     pickle.dump(journals, output)
-                # with open(
-                #     os.path.join(outpath, basename + "_sentence.pkl"), "wb"
-                # ) as output:
-                #     pickle.dump(sentence_list, output)
-                with open(
-                    os.path.join(outpath, basename + "_entity.pkl"), "wb"
-                ) as output:
-                    pickle.dump(entity_list, output)
-                # with open(
-                #     os.path.join(outpath, basename + "_span.pkl"), "wb"
-                # ) as output:
-                #     pickle.dump(span_list, output)
-
-    # combine pickled data to generate pubtator_data.json
-    pmid_list = sorted(glob.glob(os.path.join(outpath, "*id.pkl")))
-    # title_list = sorted(glob.glob(os.path.join(outpath, "*title.pkl")))
-    # journal_list = sorted(glob.glob(os.path.join(outpath, "*journal.pkl")))
-    # sentence_list = sorted(glob.glob(os.path.join(outpath, "*sentence.pkl")))
-    # span_list = sorted(glob.glob(os.path.join(outpath, "*span.pkl")))
-    entity_list = sorted(glob.glob(os.path.join(outpath, "*entity.pkl")))
-
-    pmids_all = []
-    for pmid in pmid_list:
-        with open(pmid, "rb") as f:
-            pmids = pickle.load(f)
-        pmids_all.extend(pmids)
-
-    # titles_all = []
-    # for file in title_list:
-    #     with open(file, "rb") as f:
-    #         titles = pickle.load(f)
-    #     titles_all.extend(titles)
-
-    # journals_all = []
-    # for file in journal_list:
-    #     with open(file, "rb") as f:
-    #         journals = pickle.load(f)
-    #     journals_all.extend(journals)
-
-    # sentences_all = []
-    # for file in sentence_list:
-    #     with open(file, "rb") as f:
-    #         sentences = pickle.load(f)
-    #     sentences_all.extend(sentences)
-
-    # spans_all = []
-    # for file in span_list:
-    #     with open(file, "rb") as f:
-    #         spans = pickle.load(f)
-    #     spans_all.extend(spans)
-
-    entities_all = []
-    for file in entity_list:
-        with open(file, "rb") as f:
-            entities = pickle.load(f)
-        entities_all.extend(entities)
-
-    pubtator_data = []
-    for pmid, entity in zip(pmids_all, entities_all):
-        if len(entity) >= 2:  # set minimum number of annotated sentences in an article
-            data_dict = {
+class GroundingCache:
+    # two-tier cache for gilda.ground(text, context=sentence):
+    # - tier 1 maps the surface text to its grounding for strings whose result
+    #   cannot depend on the context (at most one candidate, or no
+    #   disambiguation model for the string)
+    # - tier 2 keeps the candidate list of the remaining (ambiguous) strings,
+    #   so that only the disambiguation step is run for each new context
+    def __init__(self, max_entries: int or None = 1000000) -> None:
+        self.grounder = gilda.api.grounder.get_grounder()
+        self.models = set(self.grounder.get_models()) | set(
+            self.grounder.adeft_disambiguators
+        )
+        self.max_entries = max_entries
+        self.unambiguous = {}
+        self.candidates = {}
+        self.counters = {"tier1_hits": 0, "tier2_hits": 0, "misses": 0}
+
+    def ground(self, text: str, context: str) -> str or None:
+        if text in self.unambiguous:
+            self.counters["tier1_hits"] += 1
+            return self.unambiguous[text]
+        if text in self.candidates:
+            self.counters["tier2_hits"] += 1
+            return self._disambiguate(text, self.candidates[text], context)
+        self.counters["misses"] += 1
+        matches = self.grounder.ground(text)
+        if (len(matches) <= 1) or (text.strip() not in self.models):
+            grounded = _format_grounding(matches)
+            self._store(self.unambiguous, text, grounded)
+            return grounded
+        self._store(self.candidates, text, matches)
+        return self._disambiguate(text, matches, context)
+
+    def _disambiguate(self, text: str, candidates: list, context: str) -> str or None:
+        # same steps as Grounder.ground after merging equivalent matches;
+        # disambiguation rescales scores in place, so it works on copies
+        matches = copy.deepcopy(
+            sorted(candidates, key=lambda x: (x.term.db, x.term.id))
+        )
+        matches = self.grounder.disambiguate(text.strip(), matches, context)
+        score_namespace = getattr(self.grounder, "_score_namespace", None)
+        if score_namespace is not None:
+            rank_fun = lambda x: (x.score, score_namespace(x.term))
+        else:
+            rank_fun = lambda x: x.score
+        return _format_grounding(sorted(matches, key=rank_fun, reverse=True))
+
+    def _store(self, tier: dict, text: str, value) -> None:
+        tier[text] = value
+        if (self.max_entries is not None) and (len(tier) > self.max_entries):
+            del tier[next(iter(tier))]  # drop the oldest entry
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "tier1_size": len(self.unambiguous),
+            "tier2_size": len(self.candidates),
+        }
+
+
+def load_nlp(model: str, sentencizer: bool = False):
+    # loads a pipeline that only runs what is needed for doc.sents; the rule-based
+    # sentencizer is much faster but less accurate than the parser of the model
+    if sentencizer:
+        nlp = spacy.blank("en")
+        nlp.add_pipe("sentencizer")
+        return nlp
+    nlp = spacy.load(model)
+    nlp.select_pipes(
+        enable=[
+            name
+            for name in nlp.pipe_names
+            if name in ("tok2vec", "parser", "senter", "sentencizer")
+        ]
+    )
+    return nlp
+
+
+def _init_worker(
+    model: str, sentencizer: bool = False, batch_size: int = 256, n_process: int = 1
+) -> None:
+    global nlp, grounding_cache
+    nlp = load_nlp(model, sentencizer)
+    grounding_cache = GroundingCache()
+    pipe_options["batch_size"] = batch_size
+    pipe_options["n_process"] = n_process
+    # os.environ["PYSTOW_HOME"] = "./pystow_data"
+
+
+class WorkerPool:
+    # pool of worker processes set up by _init_worker; a worker that dies (e.g.
+    # killed for memory, or a crash in spacy) breaks the pool, which is then
+    # replaced by a new one
+    def __init__(self, workers: int, initargs: tuple) -> None:
+        self.workers = workers
+        self.initargs = initargs
+        self.executor = self.create()
+
+    def create(self, workers: int or None = None) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=workers or self.workers,
+            initializer=_init_worker,
+            initargs=self.initargs,
+        )
+
+    def submit(self, *args) -> Future:
+        return self.executor.submit(*args)
+
+    def restart(self) -> None:
+        self.executor.shutdown(wait=False)
+        self.executor = self.create()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+
+
+def iter_documents(biocxml):
+    # streams <document> elements one at a time; each element (and everything
+    # parsed before it) is cleared once the consumer moves on
+    context = ET.iterparse(biocxml, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if (event == "end") and (elem.tag == "document"):
+            yield elem
+            root.clear()
+
+
+def parse_document(document) -> dict:
+    # extracts everything needed from a <document> element into plain python;
+    # the hash of the raw element identifies unchanged documents across releases
+    id = document.find("./id").text
+    # check if pmcid if the id is a pmcid
+    pmcid = document.find("./passage/infon[@key='article-id_pmc']")
+    if pmcid:
+        pmcid = pmcid.text
+    if pmcid == id:
+        id = "PMC" + id
+    title = document.find("./passage/text").text
+    journal = document.find("./passage/infon[@key='journal']")
+    if journal is not None:
+        journal = journal.text.split(";")[0]
+    else:
+        journal = "n/a"
+
+    passages = []
+    for passage in document.findall("./passage"):
+        locations = []
+        annotations = []
+        lengths = []
+        for annotation in passage.findall("./annotation"):
+            loc = int(annotation.find("./location").attrib["offset"])
+            length = int(annotation.find("./location").attrib["length"])
+            name = annotation.find("./text").text
+            locations.append(loc)
+            annotations.append(name)
+            lengths.append(length)
+        # checking if there are any annotations in the passage
+        if len(annotations) > 0:
+            passages.append(
+                {
+                    "offset": int(passage.find("./offset").text),
+                    "text": passage.find("./text").text,
+                    "locations": np.array(locations),
+                    "annotations": annotations,
+                    "lengths": lengths,
+                }
+            )
+    return {
+        "id": id,
+        "hash": hashlib.sha1(ET.tostring(document)).hexdigest(),
+        "title": title,
+        "journal": journal,
+        "passages": passages,
+    }
+
+
+def segment_documents(documents):
+    # runs sentence segmentation on the annotated passages of chunks of
+    # documents through nlp.pipe; yields (document, sentences of each passage),
+    # where sentences are given as (start_char, text) tuples
+    documents = iter(documents)
+    while True:
+        chunk = list(islice(documents, documents_per_chunk))
+        if not chunk:
+            break
+        texts = [
+            passage["text"] for document in chunk for passage in document["passages"]
+        ]
+        docs = nlp.pipe(texts, **pipe_options)
+        for document in chunk:
+            passage_sents = []
+            for _ in document["passages"]:
+                doc = next(docs)
+                passage_sents.append(
+                    [(sent.start_char, sent.text) for sent in doc.sents]
+                )
+            yield document, passage_sents
+
+
+def assign_annotations(
+    locations: np.ndarray, sent_offsets: np.ndarray, sent_lengths: np.ndarray
+) -> list:
+    # indices of the annotations inside each sentence (in their original order);
+    # an annotation is inside a sentence if offset <= location < offset + length
+    order = np.argsort(locations, kind="stable")
+    sorted_locations = locations[order]
+    lower = np.searchsorted(sorted_locations, sent_offsets, side="left")
+    upper = np.searchsorted(sorted_locations, sent_offsets + sent_lengths, side="left")
+    return [np.sort(order[lo:up]) for lo, up in zip(lower, upper)]
+
+
+def annotate_document(document: dict, passage_sents: list) -> tuple:
+    # grounds the annotations of each sentence of the annotated passages
+    sentences = []
+    entities = []
+    spans = []
+    for passage, sents in zip(document["passages"], passage_sents):
+        locations = passage["locations"]
+        annotations = passage["annotations"]
+        lengths = np.array(passage["lengths"])
+        sent_offsets = np.array([start for start, _ in sents], dtype=np.int64)
+        sent_offsets += passage["offset"]
+        sent_lengths = np.array([len(text) for _, text in sents], dtype=np.int64)
+        assigned = assign_annotations(locations, sent_offsets, sent_lengths)
+        for (_, sent_text), offset, anno_inside in zip(sents, sent_offsets, assigned):
+            if (
+                len(anno_inside) > 0
+            ):  # checking if there are any annotations in the sentence
+                starts = locations[anno_inside] - offset
+                ends = starts + lengths[anno_inside]
+                normalized_names = []
+                in_spans = []
+                for idx, start, end in zip(anno_inside, starts, ends):
+                    normalized = grounding_cache.ground(annotations[idx], sent_text)
+                    if normalized:
+                        normalized_names.append(normalized)
+                        in_spans.append((start, end))
+                if (
+                    len(normalized_names) > 0
+                ):  # checking if the normalization was successful
+                    sentences.append(sent_text)
+                    entities.append(normalized_names)
+                    spans.append(in_spans)
+    return sentences, entities, spans
+
+
+def process_xml(biocxml, previous: dict or None = None) -> tuple:
+    # extracts ids, titles, journals and the annotated sentences of every
+    # document; previous maps ids to the (hash, entities) of an earlier run, and
+    # documents whose hash is unchanged reuse those entities (their sentences and
+    # spans are None) instead of being segmented and grounded again
+    previous = previous if previous else {}
+    ids = []
+    titles = []
+    journals = []
+    sentence_list = []
+    entity_list = []
+    span_list = []
+    hashes = []
+
+    def parse(element) -> dict:
+        document = parse_document(element)
+        if previous.get(document["id"], (None, None))[0] == document["hash"]:
+            document["passages"] = []
+        return document
+
+    documents = (parse(document) for document in iter_documents(biocxml))
+    for document, passage_sents in segment_documents(documents):
+        if previous.get(document["id"], (None, None))[0] == document["hash"]:
+            sentences, entities, spans = None, previous[document["id"]][1], None
+        else:
+            sentences, entities, spans = annotate_document(document, passage_sents)
+        ids.append(document["id"])
+        titles.append(document["title"])
+        journals.append(document["journal"])
+        sentence_list.append(sentences)
+        entity_list.append(entities)
+        span_list.append(spans)
+        hashes.append(document["hash"])
+
+    return ids, titles, journals, sentence_list, entity_list, span_list, hashes
+
+
+def write_shard(path: str, records: list) -> None:
+    # shards are written under a temporary name and renamed once complete, so a
+    # shard is either absent or whole even if the worker is killed
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, "wt") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, path)
+
+
+def process_member(
+    tar: str,
+    xml_name: str,
+    xml_path: str,
+    outpath: str,
+    archive: list,
+    previous_shard: str or None = None,
+) -> dict:
+    # xml_path is a spooled copy of the member xml_name, which is parsed
+    # incrementally from disk; archive is the [size, mtime] of the tar file;
+    # previous_shard is the shard of this member from an earlier version of the
+    # archive, if any
+    basename = os.path.basename(xml_name)
+    previous = {}
+    if previous_shard:
+        for record in read_shard(os.path.join(outpath, previous_shard)):
+            previous[record["pmid"]] = (record.get("hash"), record["entities"])
+    ids, titles, journals, sentence_list, entity_list, span_list, hashes = process_xml(
+        xml_path, previous
+    )
+
+    shard = None
+    if len(ids) != 0:
+        # one JSON Lines shard per XML file and archive version, written
+        # independently by each worker; earlier versions are kept (append-only)
+        shard = os.path.join(
+            "shards", tar, f"{basename}.{archive[0]}_{archive[1]}.jsonl.gz"
+        )
+        records = [
+            {
                 "pmid": pmid,
+                "hash": hash,
                 # "title": title,
                 # "journal": journal,
                 # "sentences": sentence,
                 # "spans": spans,
+                # only save pmid and entities for co-occurrence analysis
                 "entities": entity,
             }
-            pubtator_data.append(data_dict)
+            for pmid, hash, entity in zip(ids, hashes, entity_list)
+        ]
+        write_shard(os.path.join(outpath, shard), records)
+    return {
+        "shard": shard,
+        "articles": len(ids),
+        "reused": sum(sentences is None for sentences in sentence_list),
+        # grounding cache statistics of this worker
+        "stats": {"pid": os.getpid(), **grounding_cache.stats()},
+    }
+
+
+class Manifest:
+    # append-only record of processed archive members and the shards they were
+    # written to, used to resume runs, to find the shards of the corpus and to
+    # detect archives that changed (by size and mtime) since they were processed;
+    # failed members are recorded too, but are retried on the next run, unless
+    # their worker process died on them too often
+    def __init__(self, outpath: str) -> None:
+        self.path = os.path.join(outpath, "manifest.jsonl")
+        self.done = {}  # (tar, member) -> [size, mtime] of the archive
+        self.shards = {}  # (tar, member) -> latest shard
+        self.archives = {}  # tar -> [size, mtime] of the fully processed archive
+        self.crashes = {}  # (tar, member) -> ([size, mtime], number of crashes)
+        for record in read_manifest(outpath):
+            self._apply(record)
+        if os.path.exists(self.path):
+            # drop a partially written last line of an interrupted run, so that
+            # the records appended next start on a line of their own
+            with open(self.path, "rb+") as f:
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    f.truncate(data.rfind(b"\n") + 1)
+
+    def _apply(self, record: dict) -> None:
+        key = (record["tar"], record.get("member"))
+        if record["status"] == "done":
+            self.done[key] = record.get("archive")
+            if record.get("shard"):
+                self.shards[key] = record["shard"]
+            else:
+                self.shards.pop(key, None)
+        elif record["status"] == "removed":
+            self.done.pop(key, None)
+            self.shards.pop(key, None)
+        elif record["status"] == "failed" and "crashes" in record:
+            self.crashes[key] = (record.get("archive"), record["crashes"])
+        elif record["status"] == "complete":
+            self.archives[record["tar"]] = record["archive"]
+
+    def _append(self, record: dict) -> None:
+        self._apply(record)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def is_done(self, tar: str, member: str, archive: list or None = None) -> bool:
+        # members processed from an earlier version of the archive are not done;
+        # manifests written before archive versions were recorded have no version
+        if (tar, member) not in self.done:
+            return False
+        done_archive = self.done[tar, member]
+        return (archive is None) or (done_archive is None) or done_archive == archive
+
+    def is_complete(self, tar: str, archive: list) -> bool:
+        return self.archives.get(tar) == archive
+
+    def members(self, tar: str) -> set:
+        return {member for (name, member) in self.done if name == tar}
+
+    def record(self, tar: str, member: str, error: str or None = None, **info) -> None:
+        record = {"tar": tar, "member": member, "status": "done", **info}
+        if error is not None:
+            record["status"] = "failed"
+            record["error"] = error
+        self._append(record)
+
+    def crash(self, tar: str, member: str, archive: list, max_crashes: int) -> bool:
+        # the worker process died on this member; after max_crashes crashes on
+        # the same version of the archive the member is recorded as done without
+        # a shard, so that later runs move past it. Returns whether it was skipped
+        crashes = 1
+        if self.crashes.get((tar, member), (None, 0))[0] == archive:
+            crashes += self.crashes[tar, member][1]
+        error = "the worker process died (e.g. out of memory)"
+        if crashes < max_crashes:
+            self.record(tar, member, error, archive=archive, crashes=crashes)
+            return False
+        record = {"archive": archive, "shard": None}
+        if (tar, member) in self.shards:
+            record["replaces"] = self.shards[tar, member]
+        self.record(tar, member, skipped=error, crashes=crashes, **record)
+        return True
+
+    def remove(self, tar: str, member: str) -> None:
+        # member no longer present in the archive
+        record = {"tar": tar, "member": member, "status": "removed"}
+        if (tar, member) in self.shards:
+            record["replaces"] = self.shards[tar, member]
+        self._append(record)
+
+    def complete(self, tar: str, archive: list) -> None:
+        self._append({"tar": tar, "status": "complete", "archive": archive})
+
+
+def process_tar(
+    tarpath: str,
+    outpath: str,
+    pool: WorkerPool,
+    manifest: Manifest,
+    max_pending: int,
+    strict: bool = False,
+    worker_stats: dict or None = None,
+    max_crashes: int = 3,
+) -> int:
+    # reads the archive in a single sequential pass and hands each XML member to
+    # the worker pool; returns the number of failed members, and keeps the
+    # latest grounding cache statistics of each worker in worker_stats.
+    # Archives that are unchanged since they were fully processed are skipped;
+    # the members of changed archives are processed again, reusing the results
+    # of their unchanged documents
+    tar = os.path.basename(tarpath)
+    stat = os.stat(tarpath)
+    archive = [stat.st_size, int(stat.st_mtime)]
+    if manifest.is_complete(tar, archive):
+        return 0
+    pending = {}
+    lost = []  # members whose worker process died, with the pool
+    seen = set()
+    failed = 0
+
+    def finish(future: Future, xml_name: str, xml_path: str, previous_shard) -> None:
+        nonlocal failed
+        error = future.exception()
+        os.remove(xml_path)
+        if error is None:
+            result = future.result()
+            info = {"archive": archive, "shard": result["shard"]}
+            if previous_shard:
+                info["replaces"] = previous_shard
+            info.update(articles=result["articles"], reused=result["reused"])
+            manifest.record(tar, xml_name, **info)
+            if worker_stats is not None:
+                worker_stats[result["stats"]["pid"]] = result["stats"]
+        elif isinstance(error, BrokenProcessPool):
+            if manifest.crash(tar, xml_name, archive, max_crashes):
+                print(f"Skipped {tar}:{xml_name}: its worker died {max_crashes} times")
+            else:
+                failed += 1
+                print(f"Failed to process {tar}:{xml_name}: its worker died")
+            if strict:
+                raise error
+        else:
+            failed += 1
+            message = "".join(traceback.format_exception_only(type(error), error))
+            print(f"Failed to process {tar}:{xml_name}: {message.strip()}")
+            manifest.record(tar, xml_name, error=message.strip())
+            if strict:
+                raise error
+
+    def collect(futures) -> None:
+        for future in futures:
+            xml_name, xml_path, previous_shard = pending.pop(future)
+            if isinstance(future.exception(), BrokenProcessPool):
+                # any of the members on the pool may have killed it
+                lost.append((xml_name, xml_path, previous_shard))
+            else:
+                finish(future, xml_name, xml_path, previous_shard)
+
+    # members are spooled to files instead of being held in memory, so neither
+    # this process nor the workers hold a whole XML file at any time
+    spool_dir = os.path.join(outpath, "spool")
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir)
+    with tarfile.open(tarpath, "r|*") as f:
+        for member in f:
+            if not member.isfile():
+                continue
+            seen.add(member.name)
+            if manifest.is_done(tar, member.name, archive):
+                continue
+            fd, xml_path = tempfile.mkstemp(suffix=".xml", dir=spool_dir)
+            with os.fdopen(fd, "wb") as spool:
+                shutil.copyfileobj(f.extractfile(member), spool, 1 << 20)
+            previous_shard = manifest.shards.get((tar, member.name))
+            args = (process_member, tar, member.name, xml_path, outpath, archive)
+            try:
+                future = pool.submit(*args, previous_shard)
+            except BrokenProcessPool:
+                # a worker died since the last submit; the members that were on
+                # the pool are lost, and the rest goes to a new pool
+                collect(list(wait(pending).done))
+                pool.restart()
+                future = pool.submit(*args, previous_shard)
+            pending[future] = (member.name, xml_path, previous_shard)
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+    collect(list(wait(pending).done))
+    # the lost members are run again one at a time, in a pool of a single worker,
+    # so that only the member that kills its worker is recorded as failed
+    executor = None
+    try:
+        for xml_name, xml_path, previous_shard in lost:
+            if executor is None:
+                executor = pool.create(1)
+            future = executor.submit(
+                process_member,
+                tar,
+                xml_name,
+                xml_path,
+                outpath,
+                archive,
+                previous_shard,
+            )
+            wait([future])
+            if isinstance(future.exception(), BrokenProcessPool):
+                executor.shutdown(wait=False)
+                executor = None
+            finish(future, xml_name, xml_path, previous_shard)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    # members of an earlier version of the archive that no longer exist
+    for member in manifest.members(tar) - seen:
+        manifest.remove(tar, member)
+    if failed == 0:
+        manifest.complete(tar, archive)
+    return failed
+
+
+def merge_outputs(outpath: str, out_file: str = "pubtator_data.json") -> None:
+    # stream the shards into pubtator_data.json, one article at a time
+    with open(out_file, "w") as f:
+        f.write("[")
+        n_written = 0
+        for record in iter_shard_records(outpath):
+            # set minimum number of annotated sentences in an article
+            if len(record["entities"]) >= 2:
+                if n_written:
+                    f.write(", ")
+                # the content hash is only needed for incremental updates
+                f.write(
+                    json.dumps({"pmid": record["pmid"], "entities": record["entities"]})
+                )
+                n_written += 1
+        f.write("]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract grounded entities from PubTator Central BioC-XML tars."
+    )
+    parser.add_argument(
+        "--datapath", default="./data", help="location of pubtator tar files"
+    )
+    parser.add_argument("--outpath", default="./pubtator_processed")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--model", default="en_core_sci_sm")
+    parser.add_argument(
+        "--sentencizer",
+        action="store_true",
+        help="use spacy's rule-based sentencizer instead of the model's parser",
+    )
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--n-process", type=int, default=1, help="processes used by nlp.pipe"
+    )
+    parser.add_argument(
+        "--max-crashes",
+        type=int,
+        default=3,
+        help="skip a file in later runs once its worker process died this often",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="abort on the first file that fails instead of skipping it",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.outpath):
+        os.mkdir(args.outpath)
+    # spooled members left behind by an aborted run
+    shutil.rmtree(os.path.join(args.outpath, "spool"), ignore_errors=True)
+    # completed members are skipped, so an interrupted run resumes where it stopped
+    manifest = Manifest(args.outpath)
+
+    failed = 0
+    worker_stats = {}
+    pool = WorkerPool(
+        args.workers, (args.model, args.sentencizer, args.batch_size, args.n_process)
+    )
+    try:
+        # process each tar file
+        for tar in sorted(os.listdir(args.datapath)):
+            failed += process_tar(
+                os.path.join(args.datapath, tar),
+                args.outpath,
+                pool,
+                manifest,
+                max_pending=2 * args.workers,
+                strict=args.strict,
+                worker_stats=worker_stats,
+                max_crashes=args.max_crashes,
+            )
+    finally:
+        pool.shutdown()
+    # grounding cache hit/miss counters, per worker and in total
+    with open(os.path.join(args.outpath, "grounding_stats.json"), "w") as f:
+        total = {}
+        for stats in worker_stats.values():
+            for key, value in stats.items():
+                if key != "pid":
+                    total[key] = total.get(key, 0) + value
+        json.dump({"total": total, "workers": list(worker_stats.values())}, f)
+    if failed:
+        print(f"{failed} files failed; see {manifest.path}. Rerun to retry them.")
 
-    # dump the data into a json file
-    with open("pubtator_data.json", "w") as f:
-        json.dump(pubtator_data, f)
+    merge_outputs(args.outpath)
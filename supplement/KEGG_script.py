@@ -1,8 +1,9 @@
 import os
 import urllib.request
 
-from KEGG2Model.convert_network import to_text2model
+from KEGG2Model.convert_network import iter_text2model, write_text2model
 from KEGG2Model.KGML_parser import KEGGpathway
+from KEGG2Model.kegg_cache import KEGGCache
 
 # download KGML file of Human JAK-STAT signaling pathway (hsa04630)
 if not os.path.exists("hsa04630.xml"):
@@ -18,14 +19,12 @@ if not os.path.exists(outpath):
 
 # process & visualize KGML file
 print("Processing KGML file of Human JAK-STAT signaling pathway (hsa04630)")
-p = KEGGpathway("hsa04630.xml")
+p = KEGGpathway("hsa04630.xml", cache=KEGGCache("kegg_cache.sqlite"))
 print("Writing visualization results to hsa04630.html")
 p.visualize(os.path.join(outpath, "hsa04630.html"), show=False, informative=False)
 
 # convert KGML file to Text2Model
 print("Converting KGML file to Text2Model")
-graph, reactions = to_text2model(p)
-# output Text2Model file
+# reactions are written to the Text2Model file as they are generated
 print("Writing Text2Model file to hsa04630_text2model.txt")
-with open(os.path.join(outpath, "hsa04630_text2model.txt"), "w") as f:
-    f.write(reactions)
+write_text2model(iter_text2model(p), os.path.join(outpath, "hsa04630_text2model.txt"))